@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+pygisos_lib benchmarks
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import time
+import tempfile
+import numpy as np
+
+
+def _timeit(func, repeat=5):
+    """
+    Best wall time of several runs, in seconds.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    # for
+
+    return best
+
+
+def benchmark_stretch_lut(size=4096, seed=0):
+    """
+    Compare the lookup-table stretch with the float stretch on a UInt16 band.
+    """
+    from pygisos_lib.DataManagement.Raster.RasterDataset.lookup_table import build_stretch_lut, apply_lut
+
+    rng = np.random.default_rng(seed)
+    band_array = rng.integers(0, 4096, size=(size, size), dtype=np.uint16)
+    min_val, max_val = np.percentile(band_array, 0.1), np.percentile(band_array, 99.9)
+
+    def float_path():
+        return np.clip((band_array - min_val) / (max_val - min_val) * 255, 0, 255).astype(np.uint8)
+
+    def lut_path():
+        return apply_lut(band_array, build_stretch_lut(min_val, max_val))
+
+    assert np.array_equal(float_path(), lut_path())
+    float_time = _timeit(float_path)
+    lut_time = _timeit(lut_path)
+    print(f"Stretch {size}x{size} UInt16: float {float_time:.3f}s, LUT {lut_time:.3f}s, speedup {float_time / lut_time:.1f}x")
+
+
+def _make_zonal_dataset(folder, size=4000, n_polygons=2000, seed=0, dtype='float32'):
+    """
+    Write a synthetic raster (float32 by default) and a layer of random polygons for the zonal statistics benchmarks.
+    """
+    import rasterio
+    import geopandas as gpd
+    from shapely.geometry import Point
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    input_raster = os.path.join(folder, f'values_{dtype}.tif')
+    with rasterio.open(input_raster, 'w', driver='GTiff', width=size, height=size, count=1, dtype=dtype, crs='EPSG:3857',
+                       transform=from_origin(0, size, 1, 1), nodata=-9999, tiled=True, blockxsize=256, blockysize=256) as dst:
+        dst.write(rng.normal(100, 20, size=(1, size, size)).astype(dtype))
+
+    centers = rng.uniform(0, size, size=(n_polygons, 2))
+    radii = rng.uniform(1, size / 50, size=n_polygons)
+    polygons = [Point(x, y).buffer(r, 8) for (x, y), r in zip(centers, radii)]
+    input_shp = os.path.join(folder, 'zones.shp')
+    gpd.GeoDataFrame({'zone': range(n_polygons)}, geometry=polygons, crs='EPSG:3857').to_file(input_shp)
+
+    return input_shp, input_raster
+
+
+def benchmark_zonal_statistics(size=4000, n_polygons=2000):
+    """
+    Compare the native windowed zonal statistics with the rasterstats path.
+    """
+    import geopandas as gpd
+    from pygisos_lib.RasterAnalyst.Statistical.zonal_statistics import zonal_statistics_rasterstats, zonal_statistics_native
+
+    stats = ["mean", "min", "max", "median", "count"]
+    # 整型栅格检查均值没有被截断
+    for dtype in ['float32', 'int32']:
+        with tempfile.TemporaryDirectory() as folder:
+            input_shp, input_raster = _make_zonal_dataset(folder, size, n_polygons, dtype=dtype)
+            out_rasterstats = os.path.join(folder, 'zones_rasterstats.shp')
+            out_native = os.path.join(folder, 'zones_native.shp')
+
+            rasterstats_time = _timeit(lambda: zonal_statistics_rasterstats(input_shp, input_raster, out_rasterstats, stats), repeat=1)
+            native_time = _timeit(lambda: zonal_statistics_native(input_shp, input_raster, out_native, stats), repeat=1)
+
+            diff = (gpd.read_file(out_rasterstats)[stats] - gpd.read_file(out_native)[stats]).abs().max().max()
+            print(f"Zonal statistics {n_polygons} polygons on {size}x{size} {dtype}: rasterstats {rasterstats_time:.2f}s, "
+                  f"native {native_time:.2f}s, max abs difference {diff:.3g}")
+            assert diff < 1e-3, f"The native zonal statistics differ from rasterstats on the {dtype} raster"
+
+
+def _make_classification_raster(folder, size=4000, patch=8, n_classes=6, seed=0):
+    """
+    Write a synthetic UInt8 classification raster made of square patches of random classes.
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    n_patches = -(-size // patch)
+    classes = np.kron(rng.integers(1, n_classes + 1, size=(n_patches, n_patches)), np.ones((patch, patch), dtype=np.int64))[:size, :size]
+    input_raster = os.path.join(folder, 'classes.tif')
+    with rasterio.open(input_raster, 'w', driver='GTiff', width=size, height=size, count=1, dtype='uint8', crs='EPSG:3857',
+                       transform=from_origin(0, size, 1, 1), nodata=0, tiled=True, blockxsize=256, blockysize=256) as dst:
+        dst.write(classes.astype(np.uint8), 1)
+
+    return input_raster
+
+
+def benchmark_polygon_formats(size=2000, formats=('shp', 'gpkg', 'fgb', 'parquet')):
+    """
+    Compare the polygonization throughput of the output formats.
+    """
+    from pygisos_lib.Conversion.raster_to_polygon import raster_to_polygon_rasterio
+
+    with tempfile.TemporaryDirectory() as folder:
+        input_raster = _make_classification_raster(folder, size)
+        for extension in formats:
+            output_shp = os.path.join(folder, f'polygons.{extension}')
+            elapsed = _timeit(lambda: raster_to_polygon_rasterio(input_raster, output_shp, strip_height=512), repeat=1)
+            n_features = len(_read_vector(output_shp))
+            output_size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder) if f.startswith('polygons.'))
+            print(f"Polygonize {size}x{size} to {extension}: {elapsed:.2f}s, {n_features / elapsed:,.0f} features/s, {output_size / 2 ** 20:.1f} MB")
+            for f in os.listdir(folder):
+                if f.startswith('polygons.'):
+                    os.remove(os.path.join(folder, f))
+        # for
+
+
+def benchmark_multipart_to_singlepart(n_features=1000000, n_parts=3, seed=0):
+    """
+    Compare the vectorised (geopandas explode) and the streaming (fiona) multipart to singlepart conversions.
+    """
+    import geopandas as gpd
+    import shapely
+    from pygisos_lib.DataManagement.Feature.multipart_to_singlepart import multipart_to_singlepart_geopandas, multipart_to_singlepart_shapely
+
+    rng = np.random.default_rng(seed)
+    corners = rng.uniform(0, 100000, size=(n_features * n_parts, 2))
+    parts = shapely.box(corners[:, 0], corners[:, 1], corners[:, 0] + 10, corners[:, 1] + 10)
+    multipolygons = shapely.multipolygons(parts, indices=np.repeat(np.arange(n_features), n_parts))
+
+    with tempfile.TemporaryDirectory() as folder:
+        input_shp = os.path.join(folder, 'multipart.shp')
+        gpd.GeoDataFrame({'fid_src': np.arange(n_features)}, geometry=multipolygons, crs='EPSG:3857').to_file(input_shp)
+
+        for name, func in [('geopandas', multipart_to_singlepart_geopandas), ('shapely', multipart_to_singlepart_shapely)]:
+            output_shp = os.path.join(folder, f'singlepart_{name}.shp')
+            elapsed = _timeit(lambda: func(input_shp, output_shp), repeat=1)
+            n_output = len(gpd.read_file(output_shp, ignore_geometry=True))
+            print(f"Multipart to singlepart {n_features} features ({name}): {elapsed:.2f}s, {n_output} output features")
+        # for
+
+
+def benchmark_vector_engines(n_features=200000, batch_size=50000, seed=0):
+    """
+    Compare the vector read and write engines (fiona, pyogrio, pyogrio with Arrow) on Shapefile and GeoPackage.
+    """
+    import geopandas as gpd
+    import shapely
+    from util_lib import read_feature_batches, write_feature_batches, default_vector_engine
+
+    rng = np.random.default_rng(seed)
+    corners = rng.uniform(0, 100000, size=(n_features, 2))
+    # value_geodesic超过Shapefile字段名的10个字符，分块写出时检查后续分块按截断后的字段名追加
+    gdf = gpd.GeoDataFrame({'zone': np.arange(n_features), 'class': rng.integers(1, 10, n_features), 'value': rng.normal(size=n_features),
+                            'value_geodesic': rng.normal(size=n_features), 'name': rng.choice(['forest', 'water', 'urban', 'crop'], n_features)},
+                           geometry=shapely.box(corners[:, 0], corners[:, 1], corners[:, 0] + 10, corners[:, 1] + 10), crs='EPSG:3857')
+    engines = ['fiona', 'pyogrio', 'arrow'] if default_vector_engine() == 'arrow' else ['fiona', 'pyogrio']
+
+    with tempfile.TemporaryDirectory() as folder:
+        for extension in ['shp', 'gpkg']:
+            input_file = os.path.join(folder, f'input.{extension}')
+            gdf.to_file(input_file)
+            for engine in engines:
+                output_file = os.path.join(folder, f'output_{engine}.{extension}')
+                read_time = _timeit(lambda: sum(len(b) for b in read_feature_batches(input_file, batch_size, engine=engine)), repeat=1)
+                write_time = _timeit(lambda: write_feature_batches(read_feature_batches(input_file, batch_size, engine=engine), output_file, engine=engine), repeat=1)
+                # 从内存中分块写出原始字段名的图层
+                batches_file = os.path.join(folder, f'batches_{engine}.{extension}')
+                write_feature_batches((gdf.iloc[start:start + batch_size] for start in range(0, n_features, batch_size)), batches_file, engine=engine)
+                written = gpd.read_file(batches_file)
+                assert len(written) == n_features and np.allclose(written.iloc[:, 3], gdf['value_geodesic']), \
+                    f"The {extension} written by batches with {engine} differs from the input"
+                pushdown_time = _timeit(lambda: sum(len(b) for b in read_feature_batches(input_file, batch_size, columns=['class'],
+                                                                                             where='class = 3', engine=engine)), repeat=1) \
+                    if engine != 'fiona' else float('nan')
+                print(f"{extension} {n_features} features ({engine}): read {read_time:.2f}s, read and write {write_time:.2f}s, "
+                      f"read one field where class = 3 {pushdown_time:.2f}s")
+            # for
+        # for
+
+
+def _read_vector(output_file):
+    """
+    Read a vector output, GeoParquet included.
+    """
+    import geopandas as gpd
+
+    if output_file.endswith('.parquet'):
+        return gpd.read_parquet(output_file)
+    return gpd.read_file(output_file)
+
+
+if __name__ == "__main__":
+    benchmark_stretch_lut()
+    benchmark_zonal_statistics()
+    benchmark_polygon_formats()
+    benchmark_multipart_to_singlepart()
+    benchmark_vector_engines()
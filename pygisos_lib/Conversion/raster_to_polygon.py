@@ -5,46 +5,464 @@
 Author: Zhou Ya'nan
 Date: 2021-09-16
 """
+import os
+import json
+import shutil
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from osgeo import gdal, ogr, osr
+import fiona
 import rasterio
-import geopandas as gpd
+import shapely
+from shapely.geometry import shape, mapping
+from rasterio.features import shapes
+from rasterio.windows import Window
 
+from util_lib import gdal_driver_by_file_extension, init_worker_dataset, worker_dataset
 
-def raster_to_polygon_rasterio(input_raster, output_shp):
+
+# 支持的矢量输出格式，及其图层创建选项
+VECTOR_LAYER_OPTIONS = {
+    'ESRI Shapefile': {},
+    'GPKG': {},
+    'GeoJSON': {},
+    'FlatGeobuf': {'SPATIAL_INDEX': 'YES'},
+    'Parquet': {},
+}
+
+
+@contextmanager
+def _sieved_raster(input_raster, sieve_threshold=None):
+    """
+    Remove the regions smaller than sieve_threshold pixels (4-connected, as the polygonization),
+    merging them into their largest neighbour with gdal.SieveFilter, in a temporary GeoTIFF.
+
+    Yields the input raster itself when sieve_threshold is None.
+    """
+    if not sieve_threshold:
+        yield input_raster
+        return
+
+    src_ds = gdal.Open(input_raster)
+    band = src_ds.GetRasterBand(1)
+    fd, temp_raster = tempfile.mkstemp(suffix='.tif')
+    os.close(fd)
+    try:
+        dst_ds = gdal.GetDriverByName('GTiff').Create(temp_raster, src_ds.RasterXSize, src_ds.RasterYSize, 1, band.DataType,
+                                                      ['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER'])
+        dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+        dst_ds.SetProjection(src_ds.GetProjection())
+        dst_band = dst_ds.GetRasterBand(1)
+        if band.GetNoDataValue() is not None:
+            dst_band.SetNoDataValue(band.GetNoDataValue())
+
+        # 掩膜外（NoData）的像元不参与筛除，GDAL按行流式处理
+        gdal.SieveFilter(band, band.GetMaskBand(), dst_band, sieve_threshold, 4)
+        dst_band = None
+        dst_ds = None
+        src_ds = None
+
+        yield temp_raster
+    finally:
+        os.remove(temp_raster)
+
+
+def _iter_strip_windows(src, strip_height=None):
+    """
+    Iterate the windows of horizontal strips covering the raster, aligned to the block height.
+    """
+    if strip_height is None:
+        yield Window(0, 0, src.width, src.height)
+        return
+
+    block_height = src.block_shapes[0][0]
+    strip_height = max(block_height, strip_height // block_height * block_height)
+    for row_off in range(0, src.height, strip_height):
+        yield Window(0, row_off, src.width, min(strip_height, src.height - row_off))
+    # for
+
+
+def _polygon_schema(dtype):
+    """
+    The fiona schema of the polygons, with an integer or float 'raster_val' field following the band type.
+    """
+    val_type = 'int' if np.issubdtype(np.dtype(dtype), np.integer) else 'float'
+    return {'geometry': 'Polygon', 'properties': {'raster_val': val_type}}
+
+
+def _vector_driver(output_shp, shp_format=None):
+    """
+    The output vector driver, inferred from the output extension when shp_format is None.
+    """
+    if shp_format is None:
+        shp_format = gdal_driver_by_file_extension(output_shp)
+    if shp_format not in VECTOR_LAYER_OPTIONS:
+        raise ValueError(f"Unsupported output vector format: {shp_format}")
+
+    return shp_format
+
+
+class _PolygonWriter:
+    """
+    Write the polygon records in large batches, through fiona (one transaction per batch),
+    or to GeoParquet through Arrow (one row group per batch), simplifying them on the way if required.
+    """
+
+    def __init__(self, output_shp, crs, dtype, shp_format=None, batch_size=100000, simplify_tolerance=None):
+        self.driver = _vector_driver(output_shp, shp_format)
+        self.batch_size = max(1, batch_size)
+        self.simplify_tolerance = simplify_tolerance
+        self.batch = []
+        self.integer = np.issubdtype(np.dtype(dtype), np.integer)
+
+        if self.driver == 'Parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            from pyproj import CRS
+
+            # GeoParquet的geo元数据，几何以WKB编码
+            geo = {
+                'version': '1.0.0',
+                'primary_column': 'geometry',
+                'columns': {'geometry': {
+                    'encoding': 'WKB',
+                    'geometry_types': ['Polygon'],
+                    'crs': CRS.from_wkt(crs.to_wkt()).to_json_dict() if crs else None,
+                }},
+            }
+            self.arrow_schema = pa.schema([('raster_val', pa.int64() if self.integer else pa.float64()), ('geometry', pa.binary())],
+                                          metadata={'geo': json.dumps(geo)})
+            self.dst = pq.ParquetWriter(output_shp, self.arrow_schema)
+        else:
+            self.dst = fiona.open(output_shp, 'w', driver=self.driver, crs=crs, schema=_polygon_schema(dtype),
+                                  **VECTOR_LAYER_OPTIONS[self.driver])
+
+    def write(self, records):
+        """
+        Add records to the current batch, and write the batch when it is full.
+        """
+        self.batch.extend(records)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the current batch.
+        """
+        if not self.batch:
+            return
+
+        geoms = None
+        if self.simplify_tolerance:
+            geoms = [shape(record['geometry']) for record in self.batch]
+            geoms = shapely.simplify(geoms, self.simplify_tolerance, preserve_topology=True)
+
+        if self.driver == 'Parquet':
+            import pyarrow as pa
+
+            if geoms is None:
+                geoms = [shape(record['geometry']) for record in self.batch]
+            values = np.array([record['properties']['raster_val'] for record in self.batch], dtype=np.int64 if self.integer else np.float64)
+            self.dst.write_table(pa.Table.from_arrays([pa.array(values), pa.array(shapely.to_wkb(geoms), pa.binary())], schema=self.arrow_schema))
+        elif geoms is None:
+            self.dst.writerecords(self.batch)
+        else:
+            self.dst.writerecords({'properties': record['properties'], 'geometry': mapping(geom)} for record, geom in zip(self.batch, geoms))
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.dst.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _iter_window_polygons(src, window, band=1):
+    """
+    Polygonize a window of the raster, skipping the pixels masked by the mask band (NoData, alpha or internal mask).
+    """
+    band_data = src.read(band, window=window)
+    mask = src.read_masks(band, window=window) > 0
+    cast = int if np.issubdtype(band_data.dtype, np.integer) else float
+
+    for geom, value in shapes(band_data, mask=mask, transform=src.window_transform(window)):
+        yield {'properties': {'raster_val': cast(value)}, 'geometry': geom}
+    # for
+
+
+def raster_to_polygon_rasterio(input_raster, output_shp, strip_height=None, shp_format=None, batch_size=100000,
+                               sieve_threshold=None, simplify_tolerance=None):
     """
     Polygonize a raster using rasterio.
 
+    The features are written to the output layer as they are produced, in large batches.
+    With strip_height, the band is read strip by strip, and the polygons split by a strip boundary are stitched
+    strip by strip, so the output has the same polygons as the whole band at once while the memory depends
+    on the strip size and on the polygons crossing the current boundary only.
+
     Parameters
     ----------
     input_raster : str
         The input raster.
     output_shp : str
         The output shapefile.
+    strip_height : int, optional
+        The number of rows of each strip, rounded to the block height. Default is None, i.e. the whole band at once.
+    shp_format : str, optional
+        The output format, 'ESRI Shapefile', 'GPKG', 'GeoJSON', 'FlatGeobuf' (with a spatial index) or 'Parquet' (GeoParquet).
+        Default is None, i.e. inferred from the output extension.
+    batch_size : int, optional
+        The number of features written per transaction (per row group for GeoParquet). Default is 100000.
+    sieve_threshold : int, optional
+        Merge the regions smaller than this number of pixels into their largest neighbour before polygonizing
+        (gdal.SieveFilter into a temporary raster). Default is None, i.e. no sieving.
+    simplify_tolerance : float, optional
+        Simplify each polygon with this tolerance (in CRS units), preserving its topology, as it is written.
+        The polygons are simplified independently, so a tolerance below the pixel size keeps the shared edges close.
+        Default is None, i.e. no simplification.
     """
-    # Open the input raster
-    with rasterio.open(input_raster) as src:
-        # Read the raster
-        band = src.read(1)
+    # Open the input raster, sieved if required
+    with _sieved_raster(input_raster, sieve_threshold) as polygonize_raster, rasterio.open(polygonize_raster) as src:
+        # Polygonize the raster strip by strip, and write the features in batches
+        with _PolygonWriter(output_shp, src.crs, src.dtypes[0], shp_format, batch_size, simplify_tolerance) as dst:
+            if strip_height is None:
+                dst.write(_iter_window_polygons(src, Window(0, 0, src.width, src.height)))
+            else:
+                _write_strip_polygons(dst, src, _iter_strip_windows(src, strip_height))
+        # with
+    # with
+
+    return output_shp
+
 
-        # Polygonize the raster
-        mask = band != src.nodata
-        results = ({'properties': {'raster_val': v}, 'geometry': s} for i, (s, v) in enumerate(rasterio.features.shapes(band, mask=mask, transform=src.transform)))
+def _polygonize_tile(window):
+    """
+    Polygonize a tile window in the current process, see _window_seam_polygons.
+    """
+    return _window_seam_polygons(worker_dataset(), window)
+
+
+def _window_seam_polygons(src, window):
+    """
+    Polygonize a window of the raster, telling which polygons may continue in a neighbour window.
+
+    Returns
+    -------
+    list of tuple
+        (geometry, raster_val, on_seam) for each polygon, on_seam telling if the polygon
+        touches an edge of the window which is inside the raster, i.e. may continue in a neighbour window.
+    """
+    left, bottom, right, top = rasterio.windows.bounds(window, src.transform)
+    tol_x, tol_y = abs(src.transform.a) / 2, abs(src.transform.e) / 2
+    inner_left = window.col_off > 0
+    inner_right = window.col_off + window.width < src.width
+    inner_top = window.row_off > 0
+    inner_bottom = window.row_off + window.height < src.height
+
+    results = []
+    for feature in _iter_window_polygons(src, window):
+        geom = feature['geometry']
+        xs, ys = zip(*geom['coordinates'][0])
+        on_seam = ((inner_left and min(xs) < left + tol_x) or (inner_right and max(xs) > right - tol_x)
+                   or (inner_top and max(ys) > top - tol_y) or (inner_bottom and min(ys) < bottom + tol_y))
+        results.append((geom, feature['properties']['raster_val'], on_seam))
+    # for
+
+    return results
+
+
+def _stitch_seam_polygons(geoms, values):
+    """
+    Merge the polygons sharing an edge (not only a corner) and having the same value.
+
+    Returns
+    -------
+    tuple
+        (geometries, values) of the merged polygons, in the order of their first piece.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    values = np.asarray(values)
 
-        # Convert results to GeoDataFrame and save as Shapefile
-        gdf = gpd.GeoDataFrame.from_features(list(results))
-        gdf.to_file(output_shp)
+    # 并查集：候选对由STRtree查询得到，值相同且公共边长度大于0的才合并
+    parent = np.arange(len(geoms))
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    left_idx, right_idx = shapely.STRtree(geoms).query(geoms, predicate='intersects')
+    candidates = (left_idx < right_idx) & (values[left_idx] == values[right_idx])
+    left_idx, right_idx = left_idx[candidates], right_idx[candidates]
+    shared = shapely.length(shapely.intersection(geoms[left_idx], geoms[right_idx])) > 0
+    for a, b in zip(left_idx[shared], right_idx[shared]):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    # for
+
+    roots = np.array([find(k) for k in range(len(geoms))])
+    merged_geoms, merged_values = [], []
+    for root in np.unique(roots):
+        members = geoms[roots == root]
+        # 拼接处会留下共线的节点，simplify(0)将其去除
+        merged = members[0] if len(members) == 1 else shapely.simplify(shapely.unary_union(members), 0)
+        merged_geoms.append(merged)
+        merged_values.append(values[root])
+    # for
+
+    return merged_geoms, merged_values
+
+
+def _write_window_polygons(dst, window_results):
+    """
+    Write the polygons of each window as soon as it is done, except those on a seam,
+    which are stitched and written at the end.
+    """
+    seam_geoms, seam_values = [], []
+    for results in window_results:
+        records = []
+        for geom, value, on_seam in results:
+            if on_seam:
+                seam_geoms.append(shape(geom))
+                seam_values.append(value)
+            else:
+                records.append({'properties': {'raster_val': value}, 'geometry': geom})
+        # for
+        dst.write(records)
+    # for
+
+    # 合并被窗口拼接线分割的多边形
+    if seam_geoms:
+        merged_geoms, merged_values = _stitch_seam_polygons(seam_geoms, seam_values)
+        dst.write({'properties': {'raster_val': value.item()}, 'geometry': mapping(geom)}
+                  for geom, value in zip(merged_geoms, merged_values))
+
+
+def _write_strip_polygons(dst, src, windows):
+    """
+    Write the polygons of each strip as soon as they are complete, stitching the polygons split by the strip boundaries
+    strip by strip: the pieces touching the top edge of a strip are merged with those carried from the previous strip,
+    and only the (merged) polygons reaching the bottom edge of the strip are carried to the next one.
+    """
+    tol_y = abs(src.transform.e) / 2
+    carried_geoms, carried_values = [], []
+    for window in windows:
+        _, bottom, _, top = rasterio.windows.bounds(window, src.transform)
+        inner_top = window.row_off > 0
+        inner_bottom = window.row_off + window.height < src.height
 
-        # # Write the output shapefile
-        # with fiona.open(output_shp, 'w', 'ESRI Shapefile', src.crs, src.schema) as dst:
-        #     dst.writerecords(results)
+        records, top_geoms, top_values, next_geoms, next_values = [], [], [], [], []
+        for feature in _iter_window_polygons(src, window):
+            ys = [y for _, y in feature['geometry']['coordinates'][0]]
+            if inner_top and max(ys) > top - tol_y:
+                top_geoms.append(shape(feature['geometry']))
+                top_values.append(feature['properties']['raster_val'])
+            elif inner_bottom and min(ys) < bottom + tol_y:
+                next_geoms.append(shape(feature['geometry']))
+                next_values.append(feature['properties']['raster_val'])
+            else:
+                records.append(feature)
+        # for
+        dst.write(records)
+
+        # 与上一条带拼接，拼接后仍到达本条带下边界的继续保留
+        if carried_geoms or top_geoms:
+            merged_geoms, merged_values = _stitch_seam_polygons(carried_geoms + top_geoms, carried_values + top_values)
+            reach_bottom = inner_bottom & (shapely.bounds(np.asarray(merged_geoms, dtype=object))[:, 1] < bottom + tol_y)
+            records = []
+            for geom, value, carry in zip(merged_geoms, merged_values, reach_bottom):
+                if carry:
+                    next_geoms.append(geom)
+                    next_values.append(value.item())
+                else:
+                    records.append({'properties': {'raster_val': value.item()}, 'geometry': mapping(geom)})
+            # for
+            dst.write(records)
+        carried_geoms, carried_values = next_geoms, next_values
+    # for
+
+    # 最后一条带没有内部下边界，不会有保留的多边形
+    dst.write({'properties': {'raster_val': value}, 'geometry': mapping(geom)} for geom, value in zip(carried_geoms, carried_values))
+
+
+def raster_to_polygon_tiled(input_raster, output_shp, tile_size=2048, workers=None, shp_format=None, batch_size=100000,
+                            sieve_threshold=None, simplify_tolerance=None):
+    """
+    Polygonize a raster by tiles in a process pool, and stitch the polygons split by the tile seams.
+
+    The polygons inside a tile are written as soon as the tile is done; only the polygons touching
+    an inner tile edge are kept, and those sharing an edge and the same value are merged at the end,
+    so the output has the same polygons as the serial polygonization.
+
+    Parameters
+    ----------
+    input_raster : str
+        The input raster.
+    output_shp : str
+        The output shapefile.
+    tile_size : int
+        The size of the tiles in pixels, rounded to the block size. Default is 2048.
+    workers : int, optional
+        The number of worker processes. Default is None, i.e. serially.
+    shp_format : str, optional
+        The output format, see raster_to_polygon_rasterio. Default is None, i.e. inferred from the output extension.
+    batch_size : int, optional
+        The number of features written per transaction (per row group for GeoParquet). Default is 100000.
+    sieve_threshold : int, optional
+        Merge the regions smaller than this number of pixels into their largest neighbour before polygonizing,
+        on the whole raster (gdal.SieveFilter into a temporary raster) so the tiles agree. Default is None, i.e. no sieving.
+    simplify_tolerance : float, optional
+        Simplify each polygon (after the stitching) with this tolerance, preserving its topology, as it is written.
+        The polygons are simplified independently, so a tolerance below the pixel size keeps the shared edges close.
+        Default is None, i.e. no simplification.
+    """
+    with _sieved_raster(input_raster, sieve_threshold) as polygonize_raster:
+        return _polygonize_tiles(polygonize_raster, output_shp, tile_size, workers, shp_format, batch_size, simplify_tolerance)
+
+
+def _polygonize_tiles(input_raster, output_shp, tile_size, workers, shp_format, batch_size, simplify_tolerance):
+    """
+    Polygonize the tiles of a (sieved) raster and stitch the seam polygons, see raster_to_polygon_tiled.
+    """
+    with rasterio.open(input_raster) as src:
+        crs = src.crs
+        dtype = src.dtypes[0]
+        block_height, block_width = src.block_shapes[0]
+        tile_height = max(block_height, tile_size // block_height * block_height)
+        tile_width = max(block_width, tile_size // block_width * block_width)
+        windows = [Window(col_off, row_off, min(tile_width, src.width - col_off), min(tile_height, src.height - row_off))
+                   for row_off in range(0, src.height, tile_height) for col_off in range(0, src.width, tile_width)]
+    # with
+
+    with _PolygonWriter(output_shp, crs, dtype, shp_format, batch_size, simplify_tolerance) as dst:
+        if workers is None or workers <= 1:
+            with rasterio.open(input_raster) as src:
+                _write_window_polygons(dst, (_window_seam_polygons(src, window) for window in windows))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_dataset, initargs=(input_raster,)) as executor:
+                _write_window_polygons(dst, executor.map(_polygonize_tile, windows))
+            # with
+        # if
+    # with
 
     return output_shp
 
 
-def raster_to_polygon_gdal(input_raster, output_shp, shp_format='ESRI Shapefile'):
+def raster_to_polygon_gdal(input_raster, output_shp, shp_format=None, sieve_threshold=None, simplify_tolerance=None):
     """
     Polygonize a raster using GDAL.
 
+    The band is streamed by GDAL, NoData is excluded with the mask band, and the features are
+    written in a single transaction when the output format supports it (e.g. GeoPackage).
+
     Parameters
     ----------
     input_raster : str
@@ -52,14 +470,29 @@ def raster_to_polygon_gdal(input_raster, output_shp, shp_format='ESRI Shapefile'
     output_shp : str
         The output shapefile.
     shp_format : str
-        The format of the output shapefile. Default is 'ESRI Shapefile'.
+        The format of the output shapefile, see raster_to_polygon_rasterio.
+        Default is None, i.e. inferred from the output extension.
+    sieve_threshold : int, optional
+        Merge the regions smaller than this number of pixels into their largest neighbour before polygonizing.
+        Default is None, i.e. no sieving.
+    simplify_tolerance : float, optional
+        Simplify each polygon with this tolerance, preserving its topology, before it is written to the output layer
+        (the raster is polygonized into a temporary GeoPackage first). Default is None.
+    """
+    with _sieved_raster(input_raster, sieve_threshold) as polygonize_raster:
+        return _polygonize_gdal(polygonize_raster, output_shp, shp_format, simplify_tolerance)
+
+
+def _polygonize_gdal(input_raster, output_shp, shp_format, simplify_tolerance):
+    """
+    Polygonize a raster with gdal.Polygonize, see raster_to_polygon_gdal.
     """
     # Open the input raster
     src_ds = gdal.Open(input_raster)
     band = src_ds.GetRasterBand(1)
-    nodata = band.GetNoDataValue()
 
     # Create the output shapefile
+    shp_format = _vector_driver(output_shp, shp_format)
     dst_ds = ogr.GetDriverByName(shp_format).CreateDataSource(output_shp)
     if dst_ds is None:
         raise ValueError(f"Could not create the output shapefile: {output_shp}")
@@ -67,17 +500,48 @@ def raster_to_polygon_gdal(input_raster, output_shp, shp_format='ESRI Shapefile'
     # Create the output layer
     srs = osr.SpatialReference()
     srs.ImportFromWkt(src_ds.GetProjection())
-    dst_layer = dst_ds.CreateLayer("raster", srs=srs)
-    dst_field_name = 'raster_val'
+    layer_options = [f"{key}={value}" for key, value in VECTOR_LAYER_OPTIONS[shp_format].items()]
+    dst_layer = dst_ds.CreateLayer("raster", srs=srs, geom_type=ogr.wkbPolygon, options=layer_options)
     dst_layer.CreateField(ogr.FieldDefn("raster_val", ogr.OFTInteger))
+    dst_field_index = dst_layer.GetLayerDefn().GetFieldIndex("raster_val")
+
+    # Polygonize the raster, the mask band skips NoData without reading the band into memory,
+    # GDAL reads the band line by line and writes the features as they are completed
+    mask_band = band.GetMaskBand()
+    use_transaction = dst_ds.TestCapability(ogr.ODsCTransactions)
+    if use_transaction:
+        dst_ds.StartTransaction()
+    if not simplify_tolerance:
+        gdal.Polygonize(band, mask_band, dst_layer, dst_field_index, [], callback=None)
+    else:
+        # 先矢量化到临时的GeoPackage图层，再逐个简化后写入输出图层，
+        # 输出图层只追加要素（FlatGeobuf、GeoParquet等驱动不支持回读和更新要素）
+        temp_dir = tempfile.mkdtemp()
+        try:
+            temp_ds = ogr.GetDriverByName('GPKG').CreateDataSource(os.path.join(temp_dir, 'polygons.gpkg'))
+            temp_layer = temp_ds.CreateLayer("raster", srs=srs, geom_type=ogr.wkbPolygon)
+            temp_layer.CreateField(ogr.FieldDefn("raster_val", ogr.OFTInteger))
+            temp_ds.StartTransaction()
+            gdal.Polygonize(band, mask_band, temp_layer, 0, [], callback=None)
+            temp_ds.CommitTransaction()
 
-    # Polygonize the raster
-    band_data = band.ReadAsArray()
-    mask = band_data != nodata
-    gdal.Polygonize(band, mask, dst_layer, dst_field_name, [], callback=None)
+            temp_layer.ResetReading()
+            for feature in temp_layer:
+                out_feature = ogr.Feature(dst_layer.GetLayerDefn())
+                out_feature.SetField(dst_field_index, feature.GetField(0))
+                out_feature.SetGeometry(feature.GetGeometryRef().SimplifyPreserveTopology(simplify_tolerance))
+                dst_layer.CreateFeature(out_feature)
+            # for
+            temp_layer = None
+            temp_ds = None
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    if use_transaction:
+        dst_ds.CommitTransaction()
 
     # Close the output shapefile
     dst_ds = None
+    src_ds = None
 
     return output_shp
 
@@ -5,15 +5,149 @@
 Author: Zhou Ya'nan
 Date: 2021-09-16
 """
-import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
 
+from util_lib import read_feature_batches, write_feature_batches
 
-def calculate_geometry_attribute_geopandas(input_shp, output_shp, geometry_property, coordinate_system=None):
+
+"""
+from ArcGIS
+Calculate Geometry Attributes: Adds information to a feature's attribute fields representing the spatial
+or geometric characteristics and location of each feature, such as length or area and x-, y-coordinates.
+"""
+
+# 支持的几何属性
+PLANAR_PROPERTIES = ["AREA", "PERIMETER_LENGTH", "LENGTH", "CENTROID_X", "CENTROID_Y",
+                     "EXTENT_MIN_X", "EXTENT_MIN_Y", "EXTENT_MAX_X", "EXTENT_MAX_Y"]
+GEODESIC_PROPERTIES = ["AREA_GEODESIC", "PERIMETER_LENGTH_GEODESIC", "LENGTH_GEODESIC"]
+
+
+def _transform_geometries(geoms, src_crs, dst_crs):
+    """
+    Reproject the coordinates of a geometry array, in a single NumPy buffer.
+    """
+    transformer = Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+    return shapely.transform(geoms, lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+
+
+def _geodesic_area_length(geoms, crs, need_area=True):
+    """
+    Ellipsoidal area and length of a geometry array, on the ellipsoid of the CRS.
+
+    The lengths of all segments are computed in a single vectorised Geod.inv call; the areas (only if need_area,
+    None otherwise) are computed ring by ring with Geod.polygon_area_perimeter (exterior rings added,
+    interior rings subtracted) from the same coordinate buffer.
+    """
+    geod = crs.get_geod()
+    n = len(geoms)
+
+    # 多部件拆分为单部件，面取其所有环（外环在前），线取其本身
+    parts, part_geom = shapely.get_parts(geoms, return_index=True)
+    is_polygon = shapely.get_type_id(parts) == 3
+    rings, ring_part = shapely.get_rings(parts[is_polygon], return_index=True)
+    ring_geom = part_geom[is_polygon][ring_part]
+    is_exterior = np.r_[True, ring_part[1:] != ring_part[:-1]] if len(ring_part) else np.zeros(0, dtype=bool)
+    line_mask = shapely.get_type_id(parts) == 1
+    lines = np.concatenate([rings, parts[line_mask]])
+    line_geom = np.concatenate([ring_geom, part_geom[line_mask]])
+
+    # 所有节点转为经纬度
+    coords, coord_line = shapely.get_coordinates(lines, return_index=True)
+    lons, lats = Transformer.from_crs(crs, crs.geodetic_crs, always_xy=True).transform(coords[:, 0], coords[:, 1])
+
+    # 同一条线上相邻的节点构成线段
+    segment = np.flatnonzero(coord_line[1:] == coord_line[:-1])
+    _, _, distances = geod.inv(lons[segment], lats[segment], lons[segment + 1], lats[segment + 1])
+    line_lengths = np.bincount(coord_line[segment], weights=distances, minlength=len(lines))
+    lengths = np.bincount(line_geom, weights=line_lengths, minlength=n)
+
+    if not need_area:
+        return None, lengths
+
+    # 椭球面积逐环计算（环在线的前面，编号小于环数）
+    starts = np.searchsorted(coord_line, np.arange(len(rings)))
+    ends = np.searchsorted(coord_line, np.arange(len(rings)), side='right')
+    ring_areas = np.array([abs(geod.polygon_area_perimeter(lons[s:e], lats[s:e])[0]) for s, e in zip(starts, ends)])
+    ring_areas = np.where(is_exterior, ring_areas, -ring_areas)
+    areas = np.bincount(ring_geom, weights=ring_areas, minlength=n) if len(rings) else np.zeros(n)
+
+    return areas, lengths
+
+
+def calculate_geometry_properties(geoms, crs, geometry_property, coordinate_system=None):
+    """
+    Calculate geometry properties directly from a geometry array.
+
+    Parameters
+    ----------
+    geoms : numpy.ndarray or geopandas.GeoSeries
+        The geometries.
+    crs : pyproj.CRS or str
+        The coordinate system of the geometries.
+    geometry_property : list
+        A list of [field name, property], the property being one of
+        AREA, PERIMETER_LENGTH, LENGTH, CENTROID_X, CENTROID_Y, EXTENT_MIN_X, EXTENT_MIN_Y, EXTENT_MAX_X, EXTENT_MAX_Y,
+        AREA_GEODESIC, PERIMETER_LENGTH_GEODESIC or LENGTH_GEODESIC.
+    coordinate_system : str like 'epsg:9822', optional
+        The coordinate system in which the properties are calculated. Default is None, i.e. the coordinate system of the geometries.
+
+    Returns
+    -------
+    dict
+        The float64 array of each field.
+    """
+    for _, prop in geometry_property:
+        if prop not in PLANAR_PROPERTIES + GEODESIC_PROPERTIES:
+            raise ValueError(f"Unknown geometry property: {prop}")
+
+    geoms = np.asarray(geoms, dtype=object)
+    crs = CRS.from_user_input(crs) if crs is not None else None
+
+    # 只在坐标缓冲区中投影，不复制属性表
+    if coordinate_system:
+        if crs is None:
+            raise ValueError("The input features have no coordinate system to be projected from.")
+        target_crs = CRS.from_user_input(coordinate_system)
+        geoms = _transform_geometries(geoms, crs, target_crs)
+        crs = target_crs
+
+    props = {prop for _, prop in geometry_property}
+    values = {}
+    if props & {"AREA"}:
+        values["AREA"] = shapely.area(geoms)
+    if props & {"PERIMETER_LENGTH", "LENGTH"}:
+        values["PERIMETER_LENGTH"] = values["LENGTH"] = shapely.length(geoms)
+    if props & {"CENTROID_X", "CENTROID_Y"}:
+        centroids = shapely.centroid(geoms)
+        values["CENTROID_X"], values["CENTROID_Y"] = shapely.get_x(centroids), shapely.get_y(centroids)
+    if props & {"EXTENT_MIN_X", "EXTENT_MIN_Y", "EXTENT_MAX_X", "EXTENT_MAX_Y"}:
+        bounds = shapely.bounds(geoms)
+        values["EXTENT_MIN_X"], values["EXTENT_MIN_Y"], values["EXTENT_MAX_X"], values["EXTENT_MAX_Y"] = bounds.T
+    if props & set(GEODESIC_PROPERTIES):
+        if crs is None:
+            raise ValueError("Geodesic properties require a coordinate system.")
+        values["AREA_GEODESIC"], values["PERIMETER_LENGTH_GEODESIC"] = _geodesic_area_length(geoms, crs, "AREA_GEODESIC" in props)
+        values["LENGTH_GEODESIC"] = values["PERIMETER_LENGTH_GEODESIC"]
+
+    return {field: values[prop] for field, prop in geometry_property}
+
+
+def calculate_geometry_attribute_geopandas(input_shp, output_shp, geometry_property, coordinate_system=None, batch_size=None,
+                                           columns=None, bbox=None, where=None):
     """
     Calculate geometry attributes for a shapefile using geopandas.
 
     AREA—An attribute will be added to store the area of each polygon feature.
     PERIMETER_LENGTH—An attribute will be added to store the length of the perimeter or border of each polygon feature.
+    LENGTH—An attribute will be added to store the length of each line feature.
+    CENTROID_X, CENTROID_Y—Attributes will be added to store the centroid coordinates of each feature.
+    EXTENT_MIN_X, EXTENT_MIN_Y, EXTENT_MAX_X, EXTENT_MAX_Y—Attributes will be added to store the extent of each feature.
+    AREA_GEODESIC, PERIMETER_LENGTH_GEODESIC, LENGTH_GEODESIC—The same on the ellipsoid, in square meters and meters.
+
+    The output geometries are those of the input; the coordinate system only affects the calculation.
 
     Parameters
     ----------
@@ -30,22 +164,26 @@ def calculate_geometry_attribute_geopandas(input_shp, output_shp, geometry_prope
     coordinate_system : str like 'epsg:9822'
         The coordinate system in which the coordinates, length, and area will be calculated, in EPSG code.
         The coordinate system of the input features is used by default.
+    batch_size : int, optional
+        The number of features read, calculated and written at once, for layers too large to load.
+        Default is None, i.e. the whole layer at once.
+    columns : list of str, optional
+        Copy only these attribute fields, the others are not read. Default is None, i.e. all fields.
+    bbox : tuple, optional
+        Process only the features intersecting the bounding box (xmin, ymin, xmax, ymax). Default is None.
+    where : str, optional
+        Process only the features satisfying the SQL WHERE clause, e.g. "class = 3". Default is None.
     """
-    # Read the input shapefile
-    gdf = gpd.read_file(input_shp)
-
-    gdf_copy = gdf.copy()
-    if coordinate_system:
-        gdf_copy = gdf_copy.to_crs({'init': coordinate_system})
-
-    # Calculate the geometry properties, and store in the new or existing fields
-    for prop in geometry_property:
-        if prop[1] == "AREA":
-            gdf_copy[prop[0]] = gdf_copy['geometry'].area
-        elif prop[1] == "PERIMETER_LENGTH":
-            gdf_copy[prop[0]] = gdf_copy['geometry'].length
+    def calculate_batches():
+        # Read the input shapefile, batch by batch
+        for gdf in read_feature_batches(input_shp, batch_size, columns=columns, bbox=bbox, where=where):
+            # Calculate the geometry properties, and store in the new or existing fields
+            for field, values in calculate_geometry_properties(gdf.geometry.values, gdf.crs, geometry_property, coordinate_system).items():
+                gdf[field] = values
+            yield gdf
+        # for
 
     # Write the output shapefile
-    gdf_copy.to_file(output_shp)
+    write_feature_batches(calculate_batches(), output_shp)
 
     return output_shp
@@ -5,10 +5,13 @@
 Author: Zhou Ya'nan
 Date: 2021-09-16
 """
-import geopandas as gpd
 import fiona
+import numpy as np
+import geopandas as gpd
+import shapely
 from shapely.geometry import shape, mapping
-from shapely.ops import unary_union
+
+from util_lib import read_feature_batches, write_feature_batches
 
 
 """
@@ -19,48 +22,104 @@ as many different features as parts the geometry contain, and the same attribute
 """
 
 
-def multipart_to_singlepart_shapely(input_shp, output_shp):
+# 多部件几何类型对应的单部件类型
+SINGLEPART_TYPES = {
+    'MultiPoint': 'Point',
+    'MultiLineString': 'LineString',
+    'MultiPolygon': 'Polygon',
+    '3D MultiPoint': '3D Point',
+    '3D MultiLineString': '3D LineString',
+    '3D MultiPolygon': '3D Polygon',
+}
+
+
+def multipart_to_singlepart_shapely(input_shp, output_shp, batch_size=10000):
     """
-    Convert a multipolygon shapefile to a polygon shapefile using shapely.
+    Convert a multipart shapefile to a singlepart shapefile using shapely, streaming the features with fiona.
+
+    Each part becomes a feature with the attributes of its source feature; features with null or
+    empty geometries are kept as they are. Only one batch of features is held in memory.
+
+    The multipart geometries are split on their GeoJSON coordinates, without building shapely geometries
+    (except for geometry collections).
     """
     # Read the input shapefile
     with fiona.open(input_shp) as source:
         # Create a schema for the output shapefile
         schema = source.schema.copy()
-        schema['geometry'] = 'Polygon'
+        schema['geometry'] = SINGLEPART_TYPES.get(schema['geometry'], schema['geometry'])
 
         # Write the output shapefile
-        with fiona.open(output_shp, 'w', 'ESRI Shapefile', schema) as output:
+        with fiona.open(output_shp, 'w', 'ESRI Shapefile', schema, crs=source.crs) as output:
+            records = []
             for elem in source:
-                # Convert the multipolygon to a polygon
-                geom = shape(elem['geometry'])
-                if geom.geom_type == 'MultiPolygon':
-                    geom = unary_union(geom)
-                output.write({
-                    'properties': elem['properties'],
-                    'geometry': mapping(geom)
-                })
+                properties = dict(elem['properties'])
+                geometry = elem['geometry']
+
+                # Split the multipart geometry into its parts, directly on the GeoJSON coordinates
+                if geometry is None or (geometry['type'] not in SINGLEPART_TYPES and geometry['type'] != 'GeometryCollection'):
+                    records.append({'properties': properties, 'geometry': geometry})
+                elif geometry['type'] == 'GeometryCollection':
+                    records.extend({'properties': properties, 'geometry': mapping(part)} for part in shapely.get_parts(shape(geometry)))
+                elif len(geometry['coordinates']) == 0:
+                    records.append({'properties': properties, 'geometry': geometry})
+                else:
+                    part_type = SINGLEPART_TYPES[geometry['type']]
+                    records.extend({'properties': properties, 'geometry': {'type': part_type, 'coordinates': coordinates}}
+                                   for coordinates in geometry['coordinates'])
+
+                if len(records) >= batch_size:
+                    output.writerecords(records)
+                    records = []
             # for
+            output.writerecords(records)
         # with
     # with
 
     return output_shp
 
 
-def multipart_to_singlepart_geopandas(input_shp, output_shp):
+def _explode_batch(gdf):
     """
-    Convert a multipolygon shapefile to a polygon shapefile using geopandas.
+    Split the multipart geometries of a GeoDataFrame into one row per part, keeping the rows
+    with null or empty geometries as they are, at their position (GeoDataFrame.explode drops them).
     """
-    # Read the input shapefile
-    gdf = gpd.read_file(input_shp)
+    geoms = gdf.geometry.values
+    parts, part_row = shapely.get_parts(np.asarray(geoms, dtype=object), return_index=True)
 
-    # Convert the multipolygons to polygons
-    gdf['geometry'] = gdf['geometry'].apply(lambda x: x.convex_hull)
+    # 没有部件的行（空几何或空的多部件几何）原样保留
+    whole_rows = np.flatnonzero(np.bincount(part_row, minlength=len(gdf)) == 0)
+    rows = np.concatenate([part_row, whole_rows])
+    order = np.argsort(rows, kind='stable')
+    exploded = gdf.iloc[rows[order]].reset_index(drop=True)
+    exploded[gdf.geometry.name] = gpd.GeoSeries(np.concatenate([parts, np.asarray(geoms[whole_rows], dtype=object)])[order],
+                                                 index=exploded.index, crs=gdf.crs)
 
-    # Write the output shapefile
-    gdf.to_file(output_shp)
+    return exploded
 
-    return output_shp
 
+def multipart_to_singlepart_geopandas(input_shp, output_shp, batch_size=None):
+    """
+    Convert a multipart shapefile to a singlepart shapefile using geopandas.
 
+    All the geometries of a batch are split at once (shapely.get_parts with the index of the source feature
+    of each part), and the attributes are replicated by that index. As with multipart_to_singlepart_shapely,
+    features with null or empty geometries are kept as they are.
 
+    Parameters
+    ----------
+    input_shp : str
+        The input shapefile.
+    output_shp : str
+        The output shapefile.
+    batch_size : int, optional
+        The number of features read, converted and written at once. Default is None, i.e. the whole layer at once.
+    """
+    # Read the input shapefile, batch by batch,
+    # and convert the multipart geometries to singlepart geometries
+    batches = (_explode_batch(gdf) for gdf in read_feature_batches(input_shp, batch_size))
+
+    # Write the output shapefile
+    write_feature_batches(batches, output_shp)
+
+    return output_shp
@@ -5,16 +5,68 @@
 Author: Zhou Ya'nan
 Date: 2021-09-16
 """
-import geopandas as gpd
+import os
+import numpy as np
+import pandas as pd
 
+from util_lib import read_attribute_table, read_feature_batches, write_feature_batches
 
-def add_increment_field_geopandas(input_shp, output_shp, field_name='increment'):
+
+"""
+from QGIS
+Add autoincremental field (native:addautoincrementalfield): adds a new integer field to a vector layer,
+with a sequential value for each feature. The numbering can restart for each group of features (GROUP_FIELDS)
+and follow a sort order (SORT_EXPRESSION, SORT_ASCENDING).
+"""
+
+
+def _check_field_name(field_name):
+    """
+    Check that the increment field name is valid.
+    """
+    if field_name == '':
+        raise ValueError("Field name cannot be empty.")
+    if field_name in ['geometry']:
+        raise ValueError(f'Field name \'{field_name}\' is reserved.')
+
+
+def _increment_values(attributes, group_fields=None, sort_fields=None, ascending=True, start=1):
+    """
+    The increment value of each row of the attribute table, numbered in the order of sort_fields
+    (the table order by default), restarting from start for each group of group_fields.
+    Sorted with a stable sort and numbered with groupby().cumcount(), all vectorised.
+
+    Returns
+    -------
+    numpy.ndarray
+        The int64 values, in the order of the rows.
+    """
+    order = attributes.reset_index(drop=True)
+    if sort_fields:
+        order = order.sort_values(list(sort_fields), ascending=ascending, kind='stable', na_position='last')
+
+    if group_fields:
+        numbers = order.groupby(list(group_fields), sort=False, dropna=False).cumcount().to_numpy()
+    else:
+        numbers = np.arange(len(order))
+
+    values = np.empty(len(order), dtype=np.int64)
+    values[order.index.to_numpy()] = numbers + start
+
+    return values
+
+
+def add_increment_field_geopandas(input_shp, output_shp, field_name='increment', batch_size=None,
+                                  columns=None, bbox=None, where=None, start=1, group_fields=None, sort_fields=None, ascending=True):
     """
     Add an increment field to a shapefile.
     The increment field is used to store the increment values starting from 1.
     The increment field will be created if it does not exist.
     Otherwise, the existing increment field will be overwritten.
 
+    With group_fields or sort_fields, only these fields are read first to number the features,
+    then the layer is streamed batch by batch.
+
     Parameters
     ----------
     input_shp: str
@@ -23,24 +75,142 @@ def add_increment_field_geopandas(input_shp, output_shp, field_name='increment')
         The output shapefile.
     field_name: str
         The name of the increment field. Default is 'increment'.
+    batch_size: int, optional
+        The number of features read, numbered and written at once. Default is None, i.e. the whole layer at once.
+    columns: list of str, optional
+        Copy only these attribute fields, the others are not read. Default is None, i.e. all fields.
+    bbox: tuple, optional
+        Process only the features intersecting the bounding box (xmin, ymin, xmax, ymax). Default is None.
+    where: str, optional
+        Process only the features satisfying the SQL WHERE clause, e.g. "class = 3". Default is None.
+    start: int
+        The first value of the numbering (of each group). Default is 1.
+    group_fields: list of str, optional
+        The numbering restarts for each combination of values of these fields. Default is None.
+    sort_fields: list of str, optional
+        The features are numbered in the order of these fields (nulls last), instead of the layer order. Default is None.
+    ascending: bool or list of bool
+        The sort order of sort_fields. Default is True.
     """
-    if field_name == '':
-        raise ValueError("Field name cannot be empty.")
-    if field_name in ['geometry']:
-        raise ValueError(f'Field name \'{field_name}\' is reserved.')
+    _check_field_name(field_name)
 
-    # Read the input shapefile
-    gdf = gpd.read_file(input_shp)
+    # 分组或排序编号时，先只读取相关字段计算编号
+    values = None
+    if group_fields or sort_fields:
+        keys = list(dict.fromkeys(list(group_fields or []) + list(sort_fields or [])))
+        # 驱动会忽略未读取的字段，where引用的字段可能不在keys中，此时读取全部属性字段后再选取
+        attributes = read_attribute_table(input_shp, None if where else keys, bbox=bbox, where=where)[keys]
+        values = _increment_values(attributes, group_fields, sort_fields, ascending, start)
 
-    # Add an increment field if it does not exist
-    # Otherwise, overwrite the existing increment field
-    if field_name not in gdf.columns:
-        gdf[field_name] = range(1, len(gdf) + 1)
-    else:
-        gdf[field_name] = range(1, len(gdf) + 1)
+    def number_batches():
+        n_features = 0
+        # Read the input shapefile, batch by batch
+        for gdf in read_feature_batches(input_shp, batch_size, columns=columns, bbox=bbox, where=where):
+            n_features += len(gdf)
+            if values is not None and n_features > len(values):
+                raise ValueError(f"The features read ({n_features}+) do not match the {len(values)} rows numbered.")
+            # Add an increment field if it does not exist
+            # Otherwise, overwrite the existing increment field
+            # (the index of the batches continues from one batch to the next)
+            gdf[field_name] = gdf.index + start if values is None else values[gdf.index]
+            yield gdf
+        # for
+        if values is not None and n_features != len(values):
+            raise ValueError(f"The {n_features} features read do not match the {len(values)} rows numbered.")
 
     # Write the output shapefile
-    gdf.to_file(output_shp)
+    write_feature_batches(number_batches(), output_shp)
 
     return output_shp
 
+
+def add_increment_field_gdal(input_shp, field_name='increment', start=1, group_fields=None, sort_fields=None, ascending=True):
+    """
+    Add an increment field to a shapefile or a GeoPackage in place, without rewriting the layer.
+
+    For a shapefile only the DBF is opened and updated, the geometries are not read nor written.
+    For a GeoPackage the values are updated in a single transaction, only the increment field being
+    written (OGR UpdateFeature, GDAL >= 3.7; SetFeature before).
+
+    Parameters
+    ----------
+    input_shp: str
+        The shapefile or GeoPackage to update.
+    field_name: str
+        The name of the increment field. Default is 'increment'.
+        The field will be created if it does not exist, otherwise its values will be overwritten.
+    start: int
+        The first value of the numbering (of each group). Default is 1.
+    group_fields: list of str, optional
+        The numbering restarts for each combination of values of these fields. Default is None.
+    sort_fields: list of str, optional
+        The features are numbered in the order of these fields (nulls last), instead of the layer order. Default is None.
+    ascending: bool or list of bool
+        The sort order of sort_fields. Default is True.
+    """
+    from osgeo import ogr
+
+    _check_field_name(field_name)
+
+    # Shapefile只打开其DBF，不读写几何
+    update_file = input_shp
+    if input_shp.lower().endswith('.shp'):
+        for dbf_ext in ['.dbf', '.DBF']:
+            if os.path.exists(os.path.splitext(input_shp)[0] + dbf_ext):
+                update_file = os.path.splitext(input_shp)[0] + dbf_ext
+        # for
+
+    ds = ogr.Open(update_file, 1)
+    if ds is None:
+        raise ValueError(f"Could not open the file for update: {input_shp}")
+    layer = ds.GetLayer(0)
+
+    # Add an increment field if it does not exist
+    layer_defn = layer.GetLayerDefn()
+    field_index = layer_defn.GetFieldIndex(field_name)
+    if field_index < 0:
+        layer.CreateField(ogr.FieldDefn(field_name, ogr.OFTInteger))
+        # Shapefile的字段名可能被截断，按位置获取新字段
+        layer_defn = layer.GetLayerDefn()
+        field_index = layer_defn.GetFieldCount() - 1
+    field_names = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
+
+    # 第一遍只读取分组和排序字段，计算编号
+    values = None
+    if group_fields or sort_fields:
+        keys = list(dict.fromkeys(list(group_fields or []) + list(sort_fields or [])))
+        for key in keys:
+            if key not in field_names:
+                raise ValueError(f"Field '{key}' does not exist.")
+        layer.SetIgnoredFields([name for name in field_names if name not in keys] + ['OGR_GEOMETRY', 'OGR_STYLE'])
+        fids, rows = [], []
+        for feature in layer:
+            fids.append(feature.GetFID())
+            rows.append([feature.GetField(key) for key in keys])
+        # for
+        values = dict(zip(fids, _increment_values(pd.DataFrame(rows, columns=keys), group_fields, sort_fields, ascending, start)))
+
+    # 第二遍写入编号，只更新该字段（不忽略其他字段，以免驱动回写空值）
+    use_update = hasattr(layer, 'UpdateFeature')
+    layer.SetIgnoredFields([])
+    layer.ResetReading()
+
+    use_transaction = ds.TestCapability(ogr.ODsCTransactions)
+    if use_transaction:
+        ds.StartTransaction()
+    for k, feature in enumerate(layer):
+        value = start + k if values is None else values[feature.GetFID()]
+        feature.SetField(field_index, int(value))
+        if use_update:
+            layer.UpdateFeature(feature, [field_index], [], False)
+        else:
+            layer.SetFeature(feature)
+    # for
+    if use_transaction:
+        ds.CommitTransaction()
+
+    # Close the file
+    layer = None
+    ds = None
+
+    return input_shp
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+***
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import numpy as np
+
+
+"""
+查找表（LUT）：整型影像的每个可能取值预先计算一次输出值，拉伸时只需按像元值索引（np.take），
+只分配一次输出数组，比逐像元的浮点运算快很多。线性拉伸、Gamma拉伸和任意色调曲线都可以表示为查找表。
+"""
+
+# UInt16的全部取值个数
+UINT16_LUT_SIZE = 65536
+
+
+def build_curve_lut(curve, lut_size=UINT16_LUT_SIZE):
+    """
+    Build an 8-bit lookup table from a tone curve.
+
+    Parameters
+    ----------
+    curve: callable
+        The tone curve, mapping the array of input values (float64) to output values in [0, 255].
+    lut_size: int, optional
+        The number of entries, i.e. the number of possible input values. Default is 65536.
+
+    Returns
+    -------
+    numpy.ndarray
+        The uint8 lookup table.
+    """
+    values = np.arange(lut_size, dtype=np.float64)
+
+    return np.clip(curve(values), 0, 255).astype(np.uint8)
+
+
+def build_stretch_lut(min_val, max_val, gamma=1.0, nodata_value=None, lut_size=UINT16_LUT_SIZE):
+    """
+    Build the 8-bit lookup table of a linear (or gamma) stretch between two bounds.
+
+    With gamma=1.0 the table gives exactly the same values as
+    np.clip((x - min_val) / (max_val - min_val) * 255, 0, 255).astype(np.uint8),
+    including a degenerate range (max_val == min_val), where the values above min_val are mapped to 255.
+
+    Parameters
+    ----------
+    min_val: float
+        The input value mapped to 0.
+    max_val: float
+        The input value mapped to 255.
+    gamma: float, optional
+        The gamma of the stretch. Default is 1.0, i.e. linear.
+    nodata_value: int or float, optional
+        The NoData value, which is mapped to 0. Default is None.
+    lut_size: int, optional
+        The number of entries, i.e. the number of possible input values. Default is 65536.
+
+    Returns
+    -------
+    numpy.ndarray
+        The uint8 lookup table.
+    """
+    if max_val == min_val:
+        # 退化的拉伸范围：与浮点公式一致，大于该值的映射为255（除以0得到+inf），其余为0
+        lut = np.where(np.arange(lut_size) > min_val, 255, 0).astype(np.uint8)
+    elif gamma == 1.0:
+        lut = build_curve_lut(lambda x: (x - min_val) / (max_val - min_val) * 255, lut_size)
+    else:
+        lut = build_curve_lut(lambda x: np.clip((x - min_val) / (max_val - min_val), 0, 1) ** (1 / gamma) * 255, lut_size)
+
+    # NoData区域设为黑色
+    if nodata_value is not None and float(nodata_value).is_integer() and 0 <= nodata_value < lut_size:
+        lut[int(nodata_value)] = 0
+
+    return lut
+
+
+def apply_lut(band_array, lut):
+    """
+    Apply a lookup table to an integer band array.
+
+    Parameters
+    ----------
+    band_array: numpy.ndarray
+        The integer band array, whose values must be lower than the size of the table.
+    lut: numpy.ndarray
+        The lookup table.
+
+    Returns
+    -------
+    numpy.ndarray
+        The band array mapped through the table, with the data type of the table.
+    """
+    if not np.issubdtype(band_array.dtype, np.integer):
+        raise ValueError(f"Lookup table requires an integer array, got {band_array.dtype}")
+
+    return np.take(lut, band_array)
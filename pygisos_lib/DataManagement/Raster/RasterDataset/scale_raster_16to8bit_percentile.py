@@ -5,13 +5,196 @@
 Author: Zhou Ya'nan
 Date: 2021-09-16
 """
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import rasterio
 from osgeo import gdal
 
+from util_lib import iter_block_windows
+from .lookup_table import build_stretch_lut, apply_lut
+
 gdal.UseExceptions()
 
 
+# UInt16的全部取值个数，直方图的桶数
+UINT16_BINS = 65536
+
+
+def _accumulate_uint16_histogram(blocks, nodata_value=None):
+    """
+    Accumulate the 65536-bin histogram of UInt16 blocks, excluding the NoData value.
+
+    Parameters
+    ----------
+    blocks: iterable of numpy.ndarray
+        The UInt16 blocks of one band.
+    nodata_value: int or float, optional
+        The NoData value. Default is None.
+
+    Returns
+    -------
+    numpy.ndarray
+        The histogram, hist[v] is the number of pixels whose value is v.
+    """
+    hist = np.zeros(UINT16_BINS, dtype=np.int64)
+    for block in blocks:
+        hist += np.bincount(block.ravel(), minlength=UINT16_BINS)
+    # for
+    if nodata_value is not None and float(nodata_value).is_integer() and 0 <= nodata_value < UINT16_BINS:
+        hist[int(nodata_value)] = 0
+
+    return hist
+
+
+def _percentile_from_histogram(hist, percentile):
+    """
+    Exact percentile of the values counted in a histogram, with the linear interpolation of numpy.percentile.
+    """
+    cum_hist = np.cumsum(hist)
+    total = int(cum_hist[-1])
+    rank = percentile / 100 * (total - 1)
+    lower_rank = int(np.floor(rank))
+    upper_rank = min(lower_rank + 1, total - 1)
+    # 第k个（从0开始）有序值，即累计频数首次大于k的取值
+    lower_val = int(np.searchsorted(cum_hist, lower_rank, side='right'))
+    upper_val = int(np.searchsorted(cum_hist, upper_rank, side='right'))
+
+    return lower_val + (rank - lower_rank) * (upper_val - lower_val)
+
+
+def percentile_bounds_from_histogram(hist, lower_percentile=0.1, upper_percentile=99.9):
+    """
+    Compute the percentile stretch bounds from a band histogram.
+
+    Parameters
+    ----------
+    hist: numpy.ndarray
+        The 65536-bin histogram of the band, see _accumulate_uint16_histogram.
+    lower_percentile: float, optional
+        The lower percentile. Default is 0.1.
+    upper_percentile: float, optional
+        The upper percentile. Default is 99.9.
+
+    Returns
+    -------
+    tuple or None
+        (min_val, max_val), or None if the histogram is empty.
+    """
+    if hist.sum() == 0:
+        return None
+
+    return _percentile_from_histogram(hist, lower_percentile), _percentile_from_histogram(hist, upper_percentile)
+
+
+def _bucket_percentile_bounds(buckets, hist_min, hist_max, lower_percentile, upper_percentile):
+    """
+    Percentile bounds from a histogram of equal-width buckets between hist_min and hist_max.
+    """
+    buckets = np.asarray(buckets, dtype=np.int64)
+    bounds = percentile_bounds_from_histogram(buckets, lower_percentile, upper_percentile)
+    if bounds is None:
+        return None
+
+    # 桶序号换算为桶中心的像元值（65536个宽度为1的桶时即为像元值本身）
+    width = (hist_max - hist_min) / len(buckets)
+    return tuple(hist_min + (idx + 0.5) * width for idx in bounds)
+
+
+def _estimate_band_bounds(in_band, lower_percentile, upper_percentile, estimate, sample_size=1000000, seed=0, confidence=0.95):
+    """
+    Estimate the percentile stretch bounds of a UInt16 band without reading every pixel.
+
+    Parameters
+    ----------
+    in_band: gdal.Band
+        The input band.
+    lower_percentile: float
+        The lower percentile.
+    upper_percentile: float
+        The upper percentile.
+    estimate: str
+        'overview': exact histogram of the smallest overview with at least sample_size pixels.
+        'statistics': the default histogram stored in the metadata, or the approximate histogram of GDAL.
+        'sample': histogram of randomly chosen blocks, until at least sample_size pixels are read.
+    sample_size: int, optional
+        The number of pixels used by the 'overview' and 'sample' modes. Default is 1000000.
+    seed: int, optional
+        The seed of the random block sample. Default is 0.
+    confidence: float, optional
+        The confidence level of the error bound of the 'sample' mode. Default is 0.95.
+
+    Returns
+    -------
+    tuple
+        (bounds, rank_error). rank_error is the bound, in percentile points, on the difference between the
+        sampled and the true percentile ranks (Dvoretzky-Kiefer-Wolfowitz inequality, assuming independent pixels).
+        It is None for the modes without an error bound.
+    """
+    nodata_value = in_band.GetNoDataValue()
+
+    if estimate == 'overview':
+        overviews = [in_band.GetOverview(k) for k in range(in_band.GetOverviewCount())]
+        if len(overviews) == 0:
+            raise ValueError("The band has no overview, build them first (gdaladdo) or use another estimate mode.")
+        # 像元数不少于sample_size的最小概视图，否则用最大的概视图
+        candidates = [ov for ov in overviews if ov.XSize * ov.YSize >= sample_size]
+        overview = min(candidates, key=lambda ov: ov.XSize * ov.YSize) if candidates else max(overviews, key=lambda ov: ov.XSize * ov.YSize)
+        windows = iter_block_windows(overview.XSize, overview.YSize, *overview.GetBlockSize())
+        hist = _accumulate_uint16_histogram((overview.ReadAsArray(*win) for win in windows), nodata_value)
+        return percentile_bounds_from_histogram(hist, lower_percentile, upper_percentile), None
+
+    if estimate == 'statistics':
+        default_hist = in_band.GetDefaultHistogram(force=False)
+        if default_hist is not None:
+            hist_min, hist_max, _, buckets = default_hist
+        else:
+            hist_min, hist_max = -0.5, UINT16_BINS - 0.5
+            buckets = in_band.GetHistogram(hist_min, hist_max, UINT16_BINS, include_out_of_range=0, approx_ok=1)
+        return _bucket_percentile_bounds(buckets, hist_min, hist_max, lower_percentile, upper_percentile), None
+
+    if estimate == 'sample':
+        block_width, block_height = in_band.GetBlockSize()
+        windows = list(iter_block_windows(in_band.XSize, in_band.YSize, block_width, block_height, min_pixels=0))
+        rng = np.random.default_rng(seed)
+
+        # 随机抽取整块读取，块内解码一次即可得到所有像元
+        sampled = []
+        n_pixels = 0
+        for k in rng.permutation(len(windows)):
+            if n_pixels >= sample_size:
+                break
+            sampled.append(windows[k])
+            n_pixels += windows[k][2] * windows[k][3]
+        # for
+        hist = _accumulate_uint16_histogram((in_band.ReadAsArray(*win) for win in sampled), nodata_value)
+        n_valid = int(hist.sum())
+        rank_error = 100 * float(np.sqrt(np.log(2 / (1 - confidence)) / (2 * n_valid))) if n_valid > 0 else None
+        return percentile_bounds_from_histogram(hist, lower_percentile, upper_percentile), rank_error
+
+    raise ValueError(f"Unknown estimate mode: {estimate}")
+
+
+def _stretch_lut(bounds, nodata_value=None, gamma=1.0):
+    """
+    Build the UInt16 to 8-bit lookup table of a band from its stretch bounds.
+    """
+    if bounds is None:
+        return np.zeros(UINT16_BINS, dtype=np.uint8)
+
+    return build_stretch_lut(bounds[0], bounds[1], gamma, nodata_value, UINT16_BINS)
+
+
+def _stretch_array(band_array, min_val, max_val):
+    """
+    Linear stretch of a band array to 8-bit, through a lookup table for 8/16-bit unsigned integers.
+    """
+    if band_array.dtype in (np.uint8, np.uint16):
+        return apply_lut(band_array, build_stretch_lut(min_val, max_val, lut_size=UINT16_BINS))
+
+    return np.clip((band_array - min_val) / (max_val - min_val) * 255, 0, 255).astype(np.uint8)
+
+
 def scale_16to8_percentile(band_array, nodata_value=None, lower_percentile=0.1, upper_percentile=99.9):
     """
     Scale 16-bit raster to 8-bit raster with percentile stretch
@@ -43,7 +226,7 @@ def scale_16to8_percentile(band_array, nodata_value=None, lower_percentile=0.1,
 
         min_val = np.percentile(valid_data, lower_percentile)
         max_val = np.percentile(valid_data, upper_percentile)
-        band_8bit = np.clip((band_array - min_val) / (max_val - min_val) * 255, 0, 255).astype(np.uint8)
+        band_8bit = _stretch_array(band_array, min_val, max_val)
 
         # 将NoData区域的值恢复为黑色
         band_8bit[mask] = 0
@@ -51,12 +234,13 @@ def scale_16to8_percentile(band_array, nodata_value=None, lower_percentile=0.1,
         # 如果没有NoData值，直接进行百分位拉伸
         min_val = np.percentile(band_array, lower_percentile)
         max_val = np.percentile(band_array, upper_percentile)
-        band_8bit = np.clip((band_array - min_val) / (max_val - min_val) * 255, 0, 255).astype(np.uint8)
+        band_8bit = _stretch_array(band_array, min_val, max_val)
 
     return band_8bit
 
 
-def scale_raster_16to8_percentile_gdal(input_raster, output_raster, lower_percentile=0.1, upper_percentile=99.9, output_format='GTiff'):
+def scale_raster_16to8_percentile_gdal(input_raster, output_raster, lower_percentile=0.1, upper_percentile=99.9, output_format='GTiff', gamma=1.0,
+                                       estimate=None, sample_size=1000000, seed=0, band_bounds=None):
     """
     Scale 16-bit raster to 8-bit raster with percentile stretch using GDAL
 
@@ -72,6 +256,20 @@ def scale_raster_16to8_percentile_gdal(input_raster, output_raster, lower_percen
         The upper percentile. Default is 99.9.
     output_format: str, optional
         The output raster format. Default is 'GTiff'.
+    gamma: float, optional
+        The gamma applied after the percentile stretch. Default is 1.0, i.e. linear.
+    estimate: str, optional
+        Estimate the stretch bounds instead of computing them from every pixel, for quick-look products:
+        'overview', 'statistics' or 'sample', see _estimate_band_bounds.
+        The stretch is then applied in a single streaming pass. Default is None, i.e. exact percentiles.
+    sample_size: int, optional
+        The number of pixels used by the 'overview' and 'sample' estimates. Default is 1000000.
+    seed: int, optional
+        The seed of the 'sample' estimate. Default is 0.
+    band_bounds: dict, optional
+        If given, filled with the stretch bounds of each band: {band index: (bounds, rank_error)}, rank_error being
+        the bound on the percentile rank error of the estimate (0.0 for exact percentiles, None if unknown),
+        see _estimate_band_bounds. Default is None.
     """
 
     in_dataset = gdal.Open(input_raster)
@@ -94,16 +292,31 @@ def scale_raster_16to8_percentile_gdal(input_raster, output_raster, lower_percen
     out_dataset.SetGeoTransform(in_dataset.GetGeoTransform())
     out_dataset.SetProjection(in_dataset.GetProjection())
 
-    # scale for each band.
+    # scale for each band, block by block.
     for band_idx in range(1, num_bands + 1):
         in_band = in_dataset.GetRasterBand(band_idx)
+        out_band = out_dataset.GetRasterBand(band_idx)
 
         nodata_value = in_band.GetNoDataValue()
-        band_array = in_band.ReadAsArray()
+        windows = list(iter_block_windows(xsize, ysize, *in_band.GetBlockSize()))
 
-        band_8bit = scale_16to8_percentile(band_array, nodata_value, lower_percentile, upper_percentile)
-        out_band = out_dataset.GetRasterBand(band_idx)
-        out_band.WriteArray(band_8bit)
+        if estimate is None:
+            # 第一遍：逐块累计直方图，得到精确的百分位数
+            hist = _accumulate_uint16_histogram((in_band.ReadAsArray(*win) for win in windows), nodata_value)
+            bounds = percentile_bounds_from_histogram(hist, lower_percentile, upper_percentile)
+            rank_error = 0.0
+        else:
+            # 估算拉伸范围，不读取全部像元
+            bounds, rank_error = _estimate_band_bounds(in_band, lower_percentile, upper_percentile, estimate, sample_size, seed)
+        if band_bounds is not None:
+            band_bounds[band_idx] = (bounds, rank_error)
+        lut = _stretch_lut(bounds, nodata_value, gamma)
+
+        # 第二遍：逐块查表拉伸并写出
+        for x_off, y_off, x_size, y_size in windows:
+            block = in_band.ReadAsArray(x_off, y_off, x_size, y_size)
+            out_band.WriteArray(apply_lut(block, lut), x_off, y_off)
+        # for
 
         # 设置输出波段的NoData值
         if nodata_value is not None:
@@ -116,7 +329,7 @@ def scale_raster_16to8_percentile_gdal(input_raster, output_raster, lower_percen
     return output_raster
 
 
-def scale_raster_16to8bit_percentile_rasterio(input_raster, output_raster, lower_percentile=0.1, upper_percentile=99.9):
+def scale_raster_16to8bit_percentile_rasterio(input_raster, output_raster, lower_percentile=0.1, upper_percentile=99.9, gamma=1.0):
     """
     Scale 16-bit raster to 8-bit raster with percentile stretch using Rasterio
 
@@ -130,16 +343,193 @@ def scale_raster_16to8bit_percentile_rasterio(input_raster, output_raster, lower
         The lower percentile. Default is 0.1.
     upper_percentile: float, optional
         The upper percentile. Default is 99.9.
+    gamma: float, optional
+        The gamma applied to the uint16 bands after the percentile stretch. Default is 1.0, i.e. linear.
     """
     with rasterio.open(input_raster) as src:
         profile = src.profile
         profile.update(dtype=rasterio.uint8, count=src.count)
         with rasterio.open(output_raster, 'w', **profile) as dst:
             for i in range(1, src.count + 1):
-                band_array = src.read(i)
-                band_8bit = scale_16to8_percentile(band_array, src.nodata, lower_percentile, upper_percentile)
-                dst.write(band_8bit, i)
+                if src.dtypes[i - 1] != 'uint16':
+                    band_array = src.read(i)
+                    band_8bit = scale_16to8_percentile(band_array, src.nodata, lower_percentile, upper_percentile)
+                    dst.write(band_8bit, i)
+                    continue
+
+                block_height, block_width = src.block_shapes[i - 1]
+                windows = [rasterio.windows.Window(*win) for win in iter_block_windows(src.width, src.height, block_width, block_height)]
+
+                # 第一遍：逐块累计直方图，得到精确的百分位数
+                hist = _accumulate_uint16_histogram((src.read(i, window=win) for win in windows), src.nodata)
+                lut = _stretch_lut(percentile_bounds_from_histogram(hist, lower_percentile, upper_percentile), src.nodata, gamma)
+
+                # 第二遍：逐块查表拉伸并写出
+                for win in windows:
+                    dst.write(apply_lut(src.read(i, window=win), lut), i, window=win)
+                # for
+            # for
         # with
     # with
 
     return output_raster
+
+
+def _iter_map_rasters(func, jobs, workers=None):
+    """
+    Map func over the jobs serially, or in a process pool when workers > 1, yielding the results in the job order.
+    """
+    if workers is None or workers <= 1:
+        for job in jobs:
+            yield func(job)
+        # for
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(func, jobs)
+
+
+def _map_rasters(func, jobs, workers=None):
+    """
+    Map func over the jobs serially, or in a process pool when workers > 1, keeping the job order.
+    """
+    return list(_iter_map_rasters(func, jobs, workers))
+
+
+def _raster_histograms_rasterio(input_raster):
+    """
+    The 65536-bin histogram of each band of a UInt16 raster, shape (bands, 65536).
+    """
+    with rasterio.open(input_raster) as src:
+        if any(dtype != 'uint16' for dtype in src.dtypes):
+            raise ValueError(f"Data type of raster file {input_raster} is not UInt16")
+
+        hists = []
+        for i in range(1, src.count + 1):
+            block_height, block_width = src.block_shapes[i - 1]
+            windows = iter_block_windows(src.width, src.height, block_width, block_height)
+            hists.append(_accumulate_uint16_histogram((src.read(i, window=rasterio.windows.Window(*win)) for win in windows), src.nodata))
+        # for
+    # with
+
+    return np.stack(hists)
+
+
+def _scale_raster_with_bounds_rasterio(job):
+    """
+    Scale one UInt16 raster to 8-bit with given per-band stretch bounds.
+    """
+    input_raster, output_raster, band_bounds, gamma = job
+    with rasterio.open(input_raster) as src:
+        profile = src.profile
+        profile.update(dtype=rasterio.uint8, count=src.count)
+        with rasterio.open(output_raster, 'w', **profile) as dst:
+            for i in range(1, src.count + 1):
+                lut = _stretch_lut(band_bounds[i - 1], src.nodata, gamma)
+                block_height, block_width = src.block_shapes[i - 1]
+                for win in iter_block_windows(src.width, src.height, block_width, block_height):
+                    win = rasterio.windows.Window(*win)
+                    dst.write(apply_lut(src.read(i, window=win), lut), i, window=win)
+                # for
+            # for
+        # with
+    # with
+
+    return output_raster
+
+
+def compute_tileset_stretch_bounds(input_rasters, lower_percentile=0.1, upper_percentile=99.9, workers=None, stats_file=None):
+    """
+    Compute global per-band percentile stretch bounds over a set of UInt16 rasters.
+
+    The band histograms of the rasters are computed in parallel and summed, so the bounds are exactly
+    those of the mosaic. The summed histograms can be cached to a stats file (.npz), which is reused
+    as long as the rasters and their modification times are unchanged.
+
+    Parameters
+    ----------
+    input_rasters: list of str
+        The input raster files, with the same number of bands.
+    lower_percentile: float, optional
+        The lower percentile. Default is 0.1.
+    upper_percentile: float, optional
+        The upper percentile. Default is 99.9.
+    workers: int, optional
+        The number of worker processes. Default is None, i.e. serially.
+    stats_file: str, optional
+        The stats file caching the histograms. Default is None, i.e. no cache.
+
+    Returns
+    -------
+    list of tuple
+        The (min_val, max_val) of each band, or None for the bands without valid pixel.
+    """
+    if len(input_rasters) == 0:
+        raise ValueError("No input raster.")
+    names = np.array([os.path.abspath(f) for f in input_rasters])
+    mtimes = np.array([os.path.getmtime(f) for f in input_rasters])
+
+    histograms = None
+    if stats_file is not None and os.path.exists(stats_file):
+        with np.load(stats_file) as stats:
+            if np.array_equal(stats['names'], names) and np.array_equal(stats['mtimes'], mtimes):
+                histograms = stats['histograms']
+        # with
+
+    if histograms is None:
+        # 直方图可直接相加，逐个累加即为整个镶嵌的直方图，内存与栅格个数无关
+        for input_raster, raster_hist in zip(input_rasters, _iter_map_rasters(_raster_histograms_rasterio, input_rasters, workers)):
+            if histograms is None:
+                histograms = raster_hist
+            elif raster_hist.shape != histograms.shape:
+                raise ValueError(f"Raster file {input_raster} does not have the same number of bands as {input_rasters[0]}.")
+            else:
+                histograms += raster_hist
+        # for
+        if stats_file is not None:
+            # 文件句柄写出，避免np.savez自动追加.npz后缀
+            with open(stats_file, 'wb') as f:
+                np.savez(f, names=names, mtimes=mtimes, histograms=histograms)
+
+    return [percentile_bounds_from_histogram(hist, lower_percentile, upper_percentile) for hist in histograms]
+
+
+def scale_tileset_16to8_percentile(input_folder, output_folder, lower_percentile=0.1, upper_percentile=99.9, gamma=1.0,
+                                   input_extension='.tif', workers=None, stats_file=None):
+    """
+    Scale a set of 16-bit tiles to 8-bit with the same percentile stretch, so the mosaic has no seams.
+
+    Parameters
+    ----------
+    input_folder: str
+        The folder of UInt16 tiles, e.g. produced by split_raster_to_tile_*.
+    output_folder: str
+        The output folder, the tiles keep their file names.
+    lower_percentile: float, optional
+        The lower percentile. Default is 0.1.
+    upper_percentile: float, optional
+        The upper percentile. Default is 99.9.
+    gamma: float, optional
+        The gamma applied after the percentile stretch. Default is 1.0, i.e. linear.
+    input_extension: str, optional
+        The extension of input tiles. Default is '.tif'.
+    workers: int, optional
+        The number of worker processes. Default is None, i.e. serially.
+    stats_file: str, optional
+        The stats file caching the tile set histograms, see compute_tileset_stretch_bounds. Default is None.
+
+    Returns
+    -------
+    list of str
+        The output rasters, in file name order.
+    """
+    input_rasters = sorted(os.path.join(input_folder, f) for f in os.listdir(input_folder) if f.endswith(input_extension))
+    if len(input_rasters) == 0:
+        raise ValueError(f"No tile with extension '{input_extension}' in folder: {input_folder}")
+
+    # 全局统计一次拉伸范围，所有瓦片使用同一查找表
+    band_bounds = compute_tileset_stretch_bounds(input_rasters, lower_percentile, upper_percentile, workers, stats_file)
+
+    jobs = [(f, os.path.join(output_folder, os.path.basename(f)), band_bounds, gamma) for f in input_rasters]
+
+    return _map_rasters(_scale_raster_with_bounds_rasterio, jobs, workers)
@@ -6,7 +6,13 @@ Author: Zhou Ya'nan
 Date: 2021-09-16
 """
 import os
+import numpy as np
 import rasterio
+import rasterio.merge
+from rasterio.windows import Window, from_bounds
+from rasterio.transform import from_origin
+
+from .tile_index import query_tile_index
 
 
 def merge_tile_to_raster_rasterio(input_folder, output_raster, input_extension='.tif'):
@@ -37,7 +43,11 @@ def merge_tile_to_raster_rasterio(input_folder, output_raster, input_extension='
         mosaic_data.append(src)
 
     # Merge the tiles into a single mosaic dataset using the merge function from rasterio
-    merged_data, merged_transform = rasterio.merge.merge(mosaic_data)
+    try:
+        merged_data, merged_transform = rasterio.merge.merge(mosaic_data)
+    finally:
+        for src in mosaic_data:
+            src.close()
 
     # Update metadata with new dimensions and transform from merged dataset
     meta.update({
@@ -52,3 +62,157 @@ def merge_tile_to_raster_rasterio(input_folder, output_raster, input_extension='
 
     # return
     return output_raster
+
+
+def _read_tile_headers(tile_files):
+    """
+    Read the georeferencing of each tile, without reading any pixel.
+    """
+    headers = []
+    for file in tile_files:
+        with rasterio.open(file) as src:
+            headers.append({
+                'path': file,
+                'bounds': tuple(src.bounds),
+                'res': src.res,
+                'width': src.width,
+                'height': src.height,
+                'count': src.count,
+                'dtype': src.dtypes[0],
+                'nodata': src.nodata,
+                'crs': src.crs,
+            })
+        # with
+    # for
+
+    return headers
+
+
+def merge_tile_to_raster_streaming(input_folder, output_raster, input_extension='.tif', memory_limit_mb=256, output_format='GTiff', as_vrt=False,
+                                   use_index=False, bounds=None):
+    """
+    Merge tiles to raster window by window, so the mosaic is never held in memory.
+
+    The union extent is computed from the tile headers only, the output is created once,
+    and each tile is copied to its window of the output in row chunks that fit the memory limit.
+    Where tiles overlap, the first tile (in file name order) wins, as in rasterio.merge.merge.
+
+    Parameters
+    ----------
+    input_folder: str
+        The folder of tiles.
+    output_raster: str
+        The output raster.
+    input_extension: str, optional
+        The extension of input tiles. Default is '.tif'.
+    memory_limit_mb: int, optional
+        The memory ceiling of the pixel buffers, in MB. Default is 256.
+    output_format: str, optional
+        The output format. Default is 'GTiff'.
+    as_vrt: bool, optional
+        Write a VRT referencing the tiles instead of a physical mosaic. Default is False.
+    use_index: bool, optional
+        Read the tile headers from the tile index of the folder (built or updated incrementally),
+        instead of opening every tile. Default is False.
+    bounds: tuple, optional
+        Only merge the tiles intersecting the bounding box (left, bottom, right, top).
+        Requires use_index. Default is None, i.e. all tiles.
+    """
+    if bounds is not None and not use_index:
+        raise ValueError("Merging the tiles of a bounding box requires use_index=True.")
+
+    # Get all the tile files
+    if use_index:
+        headers = query_tile_index(input_folder, bounds, input_extension)
+        tile_files = [header['path'] for header in headers]
+    else:
+        headers = None
+        tile_files = sorted(os.path.join(input_folder, f) for f in os.listdir(input_folder) if f.endswith(input_extension))
+    if len(tile_files) == 0:
+        raise ValueError(f"No tile with extension '{input_extension}' in folder: {input_folder}")
+
+    if as_vrt:
+        from osgeo import gdal
+        gdal.UseExceptions()
+
+        # VRT中后面的数据源覆盖前面的，倒序后同样是第一个瓦片优先
+        vrt_ds = gdal.BuildVRT(output_raster, list(reversed(tile_files)))
+        vrt_ds = None
+        return output_raster
+
+    if headers is None:
+        headers = _read_tile_headers(tile_files)
+
+    return _merge_tile_headers(headers, output_raster, memory_limit_mb, output_format)
+
+
+def _nodata_mask(data, nodata):
+    """
+    The mask of the NoData pixels, NaN NoData being matched with np.isnan (NaN never equals NaN).
+    """
+    if isinstance(nodata, float) and np.isnan(nodata):
+        return np.isnan(data)
+    return data == nodata
+
+
+def _merge_tile_headers(headers, output_raster, memory_limit_mb=256, output_format='GTiff'):
+    """
+    Write the tiles described by the headers into one output raster, chunk by chunk.
+    """
+    ref = headers[0]
+    for header in headers:
+        if header['res'] != ref['res'] or header['count'] != ref['count'] or header['dtype'] != ref['dtype']:
+            raise ValueError(f"Tile {header['path']} does not match the resolution, band count or data type of {ref['path']}")
+    # for
+
+    # 根据所有瓦片的范围计算输出范围
+    x_res, y_res = ref['res']
+    left   = min(h['bounds'][0] for h in headers)
+    bottom = min(h['bounds'][1] for h in headers)
+    right  = max(h['bounds'][2] for h in headers)
+    top    = max(h['bounds'][3] for h in headers)
+    out_width  = int(round((right - left) / x_res))
+    out_height = int(round((top - bottom) / y_res))
+    out_transform = from_origin(left, top, x_res, y_res)
+
+    nodata = ref['nodata']
+    meta = {
+        'driver': output_format,
+        'width': out_width,
+        'height': out_height,
+        'count': ref['count'],
+        'dtype': ref['dtype'],
+        'crs': ref['crs'],
+        'transform': out_transform,
+        'nodata': nodata,
+    }
+
+    # 有NoData时需要回读已写入的数据，缓冲区加倍
+    pixel_bytes = ref['count'] * np.dtype(ref['dtype']).itemsize * (2 if nodata is not None else 1)
+    memory_limit = int(memory_limit_mb * 1024 * 1024)
+
+    with rasterio.open(output_raster, 'w+', **meta) as dst:
+        # 后写入的瓦片覆盖先写入的，倒序写入使第一个瓦片优先
+        for header in reversed(headers):
+            dst_win = from_bounds(*header['bounds'], transform=out_transform).round_offsets().round_lengths()
+            col_off, row_off = int(dst_win.col_off), int(dst_win.row_off)
+            width = min(header['width'], out_width - col_off)
+            height = min(header['height'], out_height - row_off)
+            chunk_rows = max(1, memory_limit // (width * pixel_bytes))
+
+            with rasterio.open(header['path']) as src:
+                for row in range(0, height, chunk_rows):
+                    n_rows = min(chunk_rows, height - row)
+                    data = src.read(window=Window(0, row, width, n_rows))
+                    out_win = Window(col_off, row_off + row, width, n_rows)
+                    if nodata is not None:
+                        # 瓦片中的NoData不覆盖已有数据
+                        existing = dst.read(window=out_win)
+                        data = np.where(_nodata_mask(data, nodata), existing, data)
+                    dst.write(data, window=out_win)
+                # for
+            # with
+        # for
+    # with
+
+    return output_raster
@@ -6,59 +6,41 @@ Author: Zhou Ya'nan
 Date: 2021-09-16
 """
 import os
+import csv
 import math
+import numpy as np
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from osgeo import gdal
 import rasterio
 
-from util_lib import file_extension_by_gdal_driver
+from util_lib import close_worker_dataset, file_extension_by_gdal_driver, init_worker_dataset, worker_dataset
 
 gdal.UseExceptions()
 
 
-def split_raster_to_tile_gdal(input_raster, output_folder, tile_size, overlap_size=0, output_format='GTiff'):
+def _build_tile_jobs(input_raster, output_folder, src_width, src_height, tile_size, overlap_size, output_format):
     """
-    Split raster to tiles
+    Build the tile windows in row-major order.
 
-    Parameters
-    ----------
-    input_raster: str
-        The input raster file.
-    output_folder: str
-        The output directory.
-    tile_size: int
-        The tile size.
-    overlap_size: int, optional
-        The overlap size. Default is 0.
-    output_format: str, optional
-        The output format. Default is 'GTiff'.
+    Returns
+    -------
+    list of tuple
+        (i, j, x_off, y_off, x_size, y_size, out_raster) for each tile.
+        The output names only depend on (i, j), so they are the same whatever the number of workers.
     """
-
-    # 打开栅格数据集
-    src_ds = gdal.Open(input_raster)
-    if src_ds is None:
-        raise IOError('Cannot open raster file: {}'.format(input_raster))
-
-    # 获取栅格数据集的基本信息
-    src_geotransform = src_ds.GetGeoTransform()
-    src_proj         = src_ds.GetProjection()
-    src_nodata       = src_ds.GetRasterBand(1).GetNoDataValue()
-    src_data_type    = src_ds.GetRasterBand(1).DataType
-    src_width        = src_ds.RasterXSize
-    src_height       = src_ds.RasterYSize
-    src_band_count   = src_ds.RasterCount
-
     # 计算输出的行列数
     tile_width  = tile_size
     tile_height = tile_size
     overlap     = overlap_size
+    # include the marginal tiles
     n_cols      = math.ceil((src_width - overlap) / (tile_width - overlap))
     n_rows      = math.ceil((src_height - overlap) / (tile_height - overlap))
 
     image_name = os.path.basename(input_raster).split('.')[0]
     out_ext = file_extension_by_gdal_driver(output_format)
-    raster_driver = gdal.GetDriverByName(output_format)
 
-    # 逐个切割
+    jobs = []
     for i in range(n_rows):
         for j in range(n_cols):
             # 计算切割窗口
@@ -67,28 +49,302 @@ def split_raster_to_tile_gdal(input_raster, output_folder, tile_size, overlap_si
             x_size = min(tile_width, src_width - x_off)
             y_size = min(tile_height, src_height - y_off)
 
-            # 读取数据
-            tile_data = src_ds.ReadAsArray(x_off, y_off, x_size, y_size)
-
-            # 创建输出栅格数据集
             out_raster = os.path.join(output_folder, f'{image_name}_{i}_{j}.{out_ext}')
-            out_ds = raster_driver.Create(out_raster, x_size, y_size, src_band_count, src_data_type)
-            out_ds.SetGeoTransform((src_geotransform[0] + x_off * src_geotransform[1], src_geotransform[1], 0, src_geotransform[3] + y_off * src_geotransform[5], 0, src_geotransform[5]))
-            out_ds.SetProjection(src_proj)
-            out_ds.WriteArray(tile_data)
-
-            # 设置NoData值
-            out_ds.GetRasterBand(1).SetNoDataValue(src_nodata)
-            out_ds = None
+            jobs.append((i, j, x_off, y_off, x_size, y_size, out_raster))
         # for
     # for
 
+    return jobs
+
+
+def _run_tile_jobs(jobs, tile_func, library, input_raster, workers=None):
+    """
+    Run the tile jobs serially, or in a process pool when workers > 1,
+    the source raster being opened once per process with library ('gdal' or 'rasterio').
+
+    The results are returned in the same order as the jobs.
+    """
+    if workers is None or workers <= 1:
+        init_worker_dataset(input_raster, library)
+        try:
+            return [tile_func(job) for job in jobs]
+        finally:
+            close_worker_dataset()
+
+    # 每个进程处理若干连续的瓦片，减少进程间通信
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_dataset, initargs=(input_raster, library)) as executor:
+        return list(executor.map(tile_func, jobs, chunksize=chunksize))
+
+
+def _iter_tiles_from_strips(jobs, read_rows, src_height, block_height, tile_size):
+    """
+    Read the source once, top to bottom, in strips aligned to its native block height,
+    and cut every tile (including the overlapping ones) from a bounded ring buffer of decoded rows.
+
+    Parameters
+    ----------
+    jobs: list of tuple
+        The tile jobs in row-major order, see _build_tile_jobs.
+    read_rows: callable
+        read_rows(y_off, n_rows) returns the array (bands, n_rows, width) of the given rows.
+    src_height: int
+        The number of rows of the source raster.
+    block_height: int
+        The native block height of the source raster.
+    tile_size: int
+        The tile size.
+
+    Yields
+    ------
+    tuple
+        (job, tile_data), where tile_data has the shape (bands, y_size, x_size).
+    """
+    block_height = max(1, block_height)
+    capacity = tile_size + block_height
+
+    row_buffer = None   # (bands, capacity, width)
+    buf_start = 0       # 缓冲区第一行对应的源数据行号
+    buf_rows = 0        # 缓冲区中的有效行数
+
+    idx = 0
+    while idx < len(jobs):
+        # 同一行的所有瓦片共用同一个行窗口
+        row_jobs = [jobs[idx]]
+        while idx + len(row_jobs) < len(jobs) and jobs[idx + len(row_jobs)][0] == row_jobs[0][0]:
+            row_jobs.append(jobs[idx + len(row_jobs)])
+        idx += len(row_jobs)
+
+        y0 = row_jobs[0][3]
+        y1 = y0 + row_jobs[0][5]
+
+        # 丢弃已经用不到的行（环形缓冲区前移）
+        shift = min(max(0, y0 - buf_start), buf_rows)
+        if shift > 0:
+            row_buffer[:, :buf_rows - shift] = row_buffer[:, shift:buf_rows]
+            buf_start += shift
+            buf_rows -= shift
+
+        # 按块高对齐的条带顺序读取，每一行只解码一次
+        next_row = buf_start + buf_rows
+        while next_row < y1:
+            n_rows = min((next_row // block_height + 1) * block_height, src_height) - next_row
+            strip = read_rows(next_row, n_rows)
+            if row_buffer is None:
+                row_buffer = np.empty((strip.shape[0], capacity, strip.shape[2]), dtype=strip.dtype)
+            row_buffer[:, buf_rows:buf_rows + n_rows] = strip
+            buf_rows += n_rows
+            next_row += n_rows
+        # while
+
+        for job in row_jobs:
+            i, j, x_off, y_off, x_size, y_size, out_raster = job
+            tile_data = row_buffer[:, y_off - buf_start:y_off - buf_start + y_size, x_off:x_off + x_size]
+            yield job, np.ascontiguousarray(tile_data)
+        # for
+    # while
+
+
+def _write_tile_manifest(input_raster, output_folder, records):
+    """
+    Write the ordered tile manifest '<image_name>_tiles.csv' to the output folder.
+    """
+    image_name = os.path.basename(input_raster).split('.')[0]
+    manifest_file = os.path.join(output_folder, f'{image_name}_tiles.csv')
+    with open(manifest_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['row', 'col', 'x_off', 'y_off', 'x_size', 'y_size', 'tile'])
+        for i, j, x_off, y_off, x_size, y_size, out_raster in records:
+            writer.writerow([i, j, x_off, y_off, x_size, y_size, os.path.basename(out_raster)])
+    # with
+
+    return manifest_file
+
+
+def _write_tile_gdal(job, output_format):
+    """
+    Cut one tile from the source raster using GDAL.
+    """
+    i, j, x_off, y_off, x_size, y_size, out_raster = job
+
+    # 读取数据
+    src_ds = worker_dataset()
+    tile_data = src_ds.ReadAsArray(x_off, y_off, x_size, y_size)
+
+    return _create_tile_gdal(src_ds, job, tile_data, output_format)
+
+
+def _create_tile_gdal(src_ds, job, tile_data, output_format):
+    """
+    Write the tile data to a new raster using GDAL.
+    """
+    i, j, x_off, y_off, x_size, y_size, out_raster = job
+
+    # 获取栅格数据集的基本信息
+    src_geotransform = src_ds.GetGeoTransform()
+    src_proj         = src_ds.GetProjection()
+    src_nodata       = src_ds.GetRasterBand(1).GetNoDataValue()
+    src_data_type    = src_ds.GetRasterBand(1).DataType
+    src_band_count   = src_ds.RasterCount
+
+    # 单波段时按二维数组写出
+    if src_band_count == 1 and tile_data.ndim == 3:
+        tile_data = tile_data[0]
+
+    # 创建输出栅格数据集
+    raster_driver = gdal.GetDriverByName(output_format)
+    out_ds = raster_driver.Create(out_raster, x_size, y_size, src_band_count, src_data_type)
+    out_ds.SetGeoTransform((src_geotransform[0] + x_off * src_geotransform[1], src_geotransform[1], 0, src_geotransform[3] + y_off * src_geotransform[5], 0, src_geotransform[5]))
+    out_ds.SetProjection(src_proj)
+    out_ds.WriteArray(tile_data)
+
+    # 设置NoData值
+    out_ds.GetRasterBand(1).SetNoDataValue(src_nodata)
+    out_ds = None
+
+    return job
+
+
+def _write_tile_gdal_translate(job):
+    """
+    Cut one tile from the source raster using gdal_translate.
+    """
+    i, j, x_off, y_off, x_size, y_size, out_raster = job
+    gdal.Translate(out_raster, worker_dataset(), srcWin=[x_off, y_off, x_size, y_size])
+
+    return job
+
+
+def _write_tile_rasterio(job):
+    """
+    Cut one tile from the source raster using rasterio.
+    """
+    i, j, x_off, y_off, x_size, y_size, out_raster = job
+
+    # Define the window coordinates for each tile (with overlapping)
+    win = rasterio.windows.Window(x_off, y_off, x_size, y_size)
+    # Read the data from the window and create a new dataset for each tile
+    src = worker_dataset()
+    data = src.read(window=win)
+
+    return _create_tile_rasterio(src, job, data)
+
+
+def _create_tile_rasterio(src_ds, job, data):
+    """
+    Write the tile data to a new raster using rasterio.
+    """
+    i, j, x_off, y_off, x_size, y_size, out_raster = job
+    win = rasterio.windows.Window(x_off, y_off, x_size, y_size)
+
+    # build data meta info.
+    out_meta = src_ds.meta.copy()
+    out_meta['width'] = win.width
+    out_meta['height'] = win.height
+    # Adjust geo-transform based on window position
+    adjusted_geo_transform = list(src_ds.transform)
+    adjusted_geo_transform[2] += x_off * src_ds.transform.a  # Adjust X coordinate of top-left corner
+    adjusted_geo_transform[5] += y_off * src_ds.transform.e  # Adjust Y coordinate of top-left corner
+    out_meta['transform'] = tuple(adjusted_geo_transform)
+
+    with rasterio.open(out_raster, 'w', **out_meta) as dest:
+        dest.write(data)
+
+    return job
+
+
+def _split_strips_gdal(input_raster, jobs, tile_size, output_format):
+    """
+    Cut the tiles from block-aligned strips of the source raster using GDAL.
+    """
+    src_ds = gdal.Open(input_raster)
+    src_width = src_ds.RasterXSize
+    block_height = src_ds.GetRasterBand(1).GetBlockSize()[1]
+
+    def read_rows(y_off, n_rows):
+        data = src_ds.ReadAsArray(0, y_off, src_width, n_rows)
+        return data.reshape((-1,) + data.shape[-2:])
+
+    records = []
+    for job, tile_data in _iter_tiles_from_strips(jobs, read_rows, src_ds.RasterYSize, block_height, tile_size):
+        records.append(_create_tile_gdal(src_ds, job, tile_data, output_format))
+    # for
+    src_ds = None
+
+    return records
+
+
+def _split_strips_rasterio(input_raster, jobs, tile_size):
+    """
+    Cut the tiles from block-aligned strips of the source raster using rasterio.
+    """
+    records = []
+    with rasterio.open(input_raster) as src_ds:
+        block_height = src_ds.block_shapes[0][0]
+
+        def read_rows(y_off, n_rows):
+            return src_ds.read(window=rasterio.windows.Window(0, y_off, src_ds.width, n_rows))
+
+        for job, tile_data in _iter_tiles_from_strips(jobs, read_rows, src_ds.height, block_height, tile_size):
+            records.append(_create_tile_rasterio(src_ds, job, tile_data))
+        # for
+    # with
+
+    return records
+
+
+def split_raster_to_tile_gdal(input_raster, output_folder, tile_size, overlap_size=0, output_format='GTiff', workers=None, read_mode='window'):
+    """
+    Split raster to tiles
+
+    Parameters
+    ----------
+    input_raster: str
+        The input raster file.
+    output_folder: str
+        The output directory.
+    tile_size: int
+        The tile size.
+    overlap_size: int, optional
+        The overlap size. Default is 0.
+    output_format: str, optional
+        The output format. Default is 'GTiff'.
+    workers: int, optional
+        The number of worker processes, each opening its own dataset handle.
+        Default is None, i.e. the tiles are cut serially.
+    read_mode: str, optional
+        'window' reads the window of each tile separately.
+        'strip' reads the source once in strips aligned to its native block height, and cuts all tiles
+        (including the overlapping ones) from a bounded row buffer, so each source block is decoded once.
+        'strip' can not be combined with workers. Default is 'window'.
+    """
+    if read_mode not in ('window', 'strip'):
+        raise ValueError(f"Unknown read mode: {read_mode}")
+    if read_mode == 'strip' and workers is not None and workers > 1:
+        raise ValueError("The 'strip' read mode reads the source sequentially and can not be combined with workers.")
+
+    # 打开栅格数据集
+    src_ds = gdal.Open(input_raster)
+    if src_ds is None:
+        raise IOError('Cannot open raster file: {}'.format(input_raster))
+
+    # 获取栅格数据集的基本信息
+    src_width  = src_ds.RasterXSize
+    src_height = src_ds.RasterYSize
     src_ds = None
 
+    # 逐个切割
+    jobs = _build_tile_jobs(input_raster, output_folder, src_width, src_height, tile_size, overlap_size, output_format)
+    if read_mode == 'strip':
+        records = _split_strips_gdal(input_raster, jobs, tile_size, output_format)
+    else:
+        records = _run_tile_jobs(jobs, partial(_write_tile_gdal, output_format=output_format), 'gdal', input_raster, workers)
+    _write_tile_manifest(input_raster, output_folder, records)
+
     return output_folder
 
 
-def split_raster_to_tile_gdal_translate(input_raster, output_folder, tile_size, overlap_size=0, output_format='GTiff'):
+def split_raster_to_tile_gdal_translate(input_raster, output_folder, tile_size, overlap_size=0, output_format='GTiff', workers=None):
     """
     Split raster to tiles using gdal_translate
 
@@ -104,6 +360,9 @@ def split_raster_to_tile_gdal_translate(input_raster, output_folder, tile_size,
         The overlap size. Default is 0.
     output_format: str, optional
         The output format. Default is 'GTiff'.
+    workers: int, optional
+        The number of worker processes, each opening its own dataset handle.
+        Default is None, i.e. the tiles are cut serially.
     """
 
     # 打开栅格数据集
@@ -114,36 +373,17 @@ def split_raster_to_tile_gdal_translate(input_raster, output_folder, tile_size,
     # 获取栅格数据集的基本信息.
     src_width = src_ds.RasterXSize
     src_height = src_ds.RasterYSize
-
-    # 计算输出的行列数
-    tile_width  = tile_size
-    tile_height = tile_size
-    overlap     = overlap_size
-    n_cols      = math.ceil((src_width - overlap) / (tile_width - overlap))
-    n_rows      = math.ceil((src_height - overlap) / (tile_height - overlap))
+    src_ds = None
 
     # 逐个切割
-    image_name = os.path.basename(input_raster).split('.')[0]
-    out_ext = file_extension_by_gdal_driver(output_format)
-    for i in range(n_rows):
-        for j in range(n_cols):
-            # 计算切割窗口
-            x_off = j * (tile_width - overlap)
-            y_off = i * (tile_height - overlap)
-            x_size = min(tile_width, src_width - x_off)
-            y_size = min(tile_height, src_height - y_off)
-
-            # 创建输出栅格数据集
-            out_raster = os.path.join(output_folder, f'{image_name}_{i}_{j}.{out_ext}')
-            gdal.Translate(out_raster, src_ds, srcWin=[x_off, y_off, x_size, y_size])
-        # for
-    # for
-    src_ds = None
+    jobs = _build_tile_jobs(input_raster, output_folder, src_width, src_height, tile_size, overlap_size, output_format)
+    records = _run_tile_jobs(jobs, _write_tile_gdal_translate, 'gdal', input_raster, workers)
+    _write_tile_manifest(input_raster, output_folder, records)
 
     return output_folder
 
 
-def split_raster_to_tile_rasterio(input_raster, output_folder, tile_size, overlap_size=0, output_format='GTiff'):
+def split_raster_to_tile_rasterio(input_raster, output_folder, tile_size, overlap_size=0, output_format='GTiff', workers=None, read_mode='window'):
     """
     Split raster to tiles using rasterio
 
@@ -159,7 +399,19 @@ def split_raster_to_tile_rasterio(input_raster, output_folder, tile_size, overla
         The overlap size. Default is 0.
     output_format: str, optional
         The output format. Default is 'GTiff'.
+    workers: int, optional
+        The number of worker processes, each opening its own dataset handle.
+        Default is None, i.e. the tiles are cut serially.
+    read_mode: str, optional
+        'window' reads the window of each tile separately.
+        'strip' reads the source once in strips aligned to its native block height, and cuts all tiles
+        (including the overlapping ones) from a bounded row buffer, so each source block is decoded once.
+        'strip' can not be combined with workers. Default is 'window'.
     """
+    if read_mode not in ('window', 'strip'):
+        raise ValueError(f"Unknown read mode: {read_mode}")
+    if read_mode == 'strip' and workers is not None and workers > 1:
+        raise ValueError("The 'strip' read mode reads the source sequentially and can not be combined with workers.")
     # 打开栅格数据集
     src_ds = rasterio.open(input_raster)
     if src_ds is None:
@@ -168,48 +420,17 @@ def split_raster_to_tile_rasterio(input_raster, output_folder, tile_size, overla
     # 获取栅格数据集的基本信息
     src_width = src_ds.width
     src_height = src_ds.height
+    src_ds.close()
 
-    # 计算输出的行列数
-    tile_width = tile_size
-    tile_height = tile_size
-    overlap = overlap_size
-    # include the marginal tiles
-    n_cols = math.ceil((src_width - overlap) / (tile_width - overlap))
-    n_rows = math.ceil((src_height - overlap) / (tile_height - overlap))
-    # drop out the marginal tiles
+    # 逐个切割
+    # drop out the marginal tiles:
     # n_cols = math.floor((src_width - overlap) / (tile_width - overlap))
     # n_rows = math.floor((src_height - overlap) / (tile_height - overlap))
-
-    # 逐个切割
-    image_name = os.path.basename(input_raster).split('.')[0]
-    out_ext = file_extension_by_gdal_driver(output_format)
-    for i in range(n_rows):
-        for j in range(n_cols):
-            # 计算切割窗口
-            x_off  = j * (tile_width - overlap)
-            y_off  = i * (tile_height - overlap)
-            x_size = min(tile_width, src_width - x_off)
-            y_size = min(tile_height, src_height - y_off)
-
-            # Define the window coordinates for each tile (with overlapping)
-            win = rasterio.windows.Window(x_off, y_off, x_size, y_size)
-            # Read the data from the window and create a new dataset for each tile
-            data = src_ds.read(window=win)
-            # build data meta info.
-            out_meta = src_ds.meta.copy()
-            out_meta['width'] = win.width
-            out_meta['height'] = win.height
-            # Adjust geo-transform based on window position
-            adjusted_geo_transform = list(src_ds.transform)
-            adjusted_geo_transform[2] += x_off * src_ds.transform.a  # Adjust X coordinate of top-left corner
-            adjusted_geo_transform[5] += y_off * src_ds.transform.e  # Adjust Y coordinate of top-left corner
-            out_meta['transform'] = tuple(adjusted_geo_transform)
-
-            out_raster = os.path.join(output_folder, f'{image_name}_{i}_{j}.{out_ext}')
-            with rasterio.open(out_raster, 'w', **out_meta) as dest:
-                dest.write(data)
-        # for
-    # for
-    src_ds.close()
+    jobs = _build_tile_jobs(input_raster, output_folder, src_width, src_height, tile_size, overlap_size, output_format)
+    if read_mode == 'strip':
+        records = _split_strips_rasterio(input_raster, jobs, tile_size)
+    else:
+        records = _run_tile_jobs(jobs, _write_tile_rasterio, 'rasterio', input_raster, workers)
+    _write_tile_manifest(input_raster, output_folder, records)
 
     return output_folder
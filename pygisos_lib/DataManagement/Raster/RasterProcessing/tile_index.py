@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+***
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import json
+import sqlite3
+from contextlib import closing
+import rasterio
+import rasterio.merge
+
+
+"""
+瓦片索引：切片文件夹中保存一个SQLite侧车文件，记录每个瓦片的范围、仿射变换、数据类型、波段数、坐标系和修改时间，
+并用SQLite自带的R*Tree虚表做空间查询。索引只在文件新增、删除或修改时增量更新，合并和按范围读取时只打开相交的瓦片。
+"""
+
+TILE_INDEX_NAME = 'tile_index.sqlite'
+
+# 索引表结构的版本，旧版本的索引（nodata为REAL，NaN被存为NULL）在打开时重建
+TILE_INDEX_VERSION = 1
+
+
+def _connect_tile_index(index_file):
+    """
+    Open the index database, and create the tables if they do not exist.
+    """
+    conn = sqlite3.connect(index_file)
+    with conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] < TILE_INDEX_VERSION:
+            conn.execute("DROP TABLE IF EXISTS tiles")
+            conn.execute("DROP TABLE IF EXISTS tiles_rtree")
+            conn.execute(f"PRAGMA user_version = {TILE_INDEX_VERSION}")
+        # nodata以JSON文本保存，NaN保存为'NaN'（REAL列中NaN会被存为NULL）
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tiles (
+                id INTEGER PRIMARY KEY,
+                name TEXT UNIQUE NOT NULL,
+                mtime REAL NOT NULL,
+                min_x REAL, min_y REAL, max_x REAL, max_y REAL,
+                transform TEXT,
+                width INTEGER, height INTEGER, count INTEGER,
+                dtype TEXT, nodata TEXT, crs TEXT
+            )""")
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS tiles_rtree USING rtree(id, min_x, max_x, min_y, max_y)")
+    # with
+
+    return conn
+
+
+def build_tile_index(input_folder, input_extension='.tif', index_file=None):
+    """
+    Build or incrementally update the tile index of a folder.
+
+    Only the tiles that are new or whose modification time changed are opened,
+    and the tiles that no longer exist are removed from the index.
+
+    Parameters
+    ----------
+    input_folder: str
+        The folder of tiles.
+    input_extension: str, optional
+        The extension of input tiles. Default is '.tif'.
+    index_file: str, optional
+        The index file. Default is 'tile_index.sqlite' in the input folder.
+
+    Returns
+    -------
+    str
+        The index file.
+    """
+    if index_file is None:
+        index_file = os.path.join(input_folder, TILE_INDEX_NAME)
+
+    # 只获取文件的修改时间，不打开栅格
+    tile_mtimes = {entry.name: entry.stat().st_mtime for entry in os.scandir(input_folder)
+                   if entry.is_file() and entry.name.endswith(input_extension)}
+
+    with closing(_connect_tile_index(index_file)) as conn, conn:
+        indexed = {name: (tile_id, mtime) for tile_id, name, mtime in conn.execute("SELECT id, name, mtime FROM tiles")}
+
+        # 删除已经不存在的瓦片
+        removed = [(tile_id,) for name, (tile_id, mtime) in indexed.items() if name not in tile_mtimes]
+        conn.executemany("DELETE FROM tiles WHERE id = ?", removed)
+        conn.executemany("DELETE FROM tiles_rtree WHERE id = ?", removed)
+
+        # 新增或更新修改过的瓦片
+        for name, mtime in tile_mtimes.items():
+            if name in indexed and indexed[name][1] == mtime:
+                continue
+            with rasterio.open(os.path.join(input_folder, name)) as src:
+                left, bottom, right, top = src.bounds
+                record = (name, mtime, left, bottom, right, top, json.dumps(list(src.transform)[:6]),
+                          src.width, src.height, src.count, src.dtypes[0], json.dumps(src.nodata),
+                          src.crs.to_wkt() if src.crs else None)
+            # with
+            if name in indexed:
+                tile_id = indexed[name][0]
+                conn.execute("""UPDATE tiles SET name = ?, mtime = ?, min_x = ?, min_y = ?, max_x = ?, max_y = ?, transform = ?,
+                                width = ?, height = ?, count = ?, dtype = ?, nodata = ?, crs = ? WHERE id = ?""", record + (tile_id,))
+                conn.execute("DELETE FROM tiles_rtree WHERE id = ?", (tile_id,))
+            else:
+                tile_id = conn.execute("""INSERT INTO tiles (name, mtime, min_x, min_y, max_x, max_y, transform,
+                                          width, height, count, dtype, nodata, crs) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", record).lastrowid
+            conn.execute("INSERT INTO tiles_rtree VALUES (?, ?, ?, ?, ?)", (tile_id, left, right, bottom, top))
+        # for
+    # with
+
+    return index_file
+
+
+def query_tile_index(input_folder, bounds=None, input_extension='.tif', index_file=None, update=True):
+    """
+    Query the tiles intersecting a bounding box from the tile index.
+
+    Parameters
+    ----------
+    input_folder: str
+        The folder of tiles.
+    bounds: tuple, optional
+        The bounding box (left, bottom, right, top) in the CRS of the tiles. Default is None, i.e. all tiles.
+    input_extension: str, optional
+        The extension of input tiles. Default is '.tif'.
+    index_file: str, optional
+        The index file. Default is 'tile_index.sqlite' in the input folder.
+    update: bool, optional
+        Update the index incrementally before the query. Default is True.
+
+    Returns
+    -------
+    list of dict
+        The tile headers sorted by tile name, with the keys
+        'path', 'bounds', 'transform', 'res', 'width', 'height', 'count', 'dtype', 'nodata' and 'crs'.
+    """
+    if index_file is None:
+        index_file = os.path.join(input_folder, TILE_INDEX_NAME)
+    if update or not os.path.exists(index_file):
+        build_tile_index(input_folder, input_extension, index_file)
+
+    columns = "t.name, t.min_x, t.min_y, t.max_x, t.max_y, t.transform, t.width, t.height, t.count, t.dtype, t.nodata, t.crs"
+    with closing(_connect_tile_index(index_file)) as conn:
+        if bounds is None:
+            rows = conn.execute(f"SELECT {columns} FROM tiles t ORDER BY t.name").fetchall()
+        else:
+            left, bottom, right, top = bounds
+            # R*Tree中的坐标为单精度，先粗查，再用双精度范围精确判断
+            rows = conn.execute(f"""SELECT {columns} FROM tiles t JOIN tiles_rtree r ON t.id = r.id
+                                    WHERE r.max_x >= ? AND r.min_x <= ? AND r.max_y >= ? AND r.min_y <= ?
+                                    ORDER BY t.name""", (left, right, bottom, top)).fetchall()
+            rows = [row for row in rows if row[3] > left and row[1] < right and row[4] > bottom and row[2] < top]
+    # with
+
+    headers = []
+    for name, min_x, min_y, max_x, max_y, transform, width, height, count, dtype, nodata, crs in rows:
+        transform = json.loads(transform)
+        headers.append({
+            'path': os.path.join(input_folder, name),
+            'bounds': (min_x, min_y, max_x, max_y),
+            'transform': transform,
+            'res': (transform[0], -transform[4]),
+            'width': width,
+            'height': height,
+            'count': count,
+            'dtype': dtype,
+            'nodata': json.loads(nodata),
+            'crs': crs,
+        })
+    # for
+
+    return headers
+
+
+def read_bbox_from_tiles(input_folder, bounds, input_extension='.tif', index_file=None, update=True):
+    """
+    Read the pixels of a bounding box from a tile set, opening only the intersecting tiles.
+
+    Parameters
+    ----------
+    input_folder: str
+        The folder of tiles.
+    bounds: tuple
+        The bounding box (left, bottom, right, top) in the CRS of the tiles.
+    input_extension: str, optional
+        The extension of input tiles. Default is '.tif'.
+    index_file: str, optional
+        The index file. Default is 'tile_index.sqlite' in the input folder.
+    update: bool, optional
+        Update the index incrementally before the query. Default is True.
+
+    Returns
+    -------
+    tuple
+        (data, transform), the array (bands, rows, cols) of the bounding box and its affine transform.
+    """
+    headers = query_tile_index(input_folder, bounds, input_extension, index_file, update)
+    if len(headers) == 0:
+        raise ValueError(f"No tile intersects the bounds: {bounds}")
+
+    return rasterio.merge.merge([header['path'] for header in headers], bounds=bounds)
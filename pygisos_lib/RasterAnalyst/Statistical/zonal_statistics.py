@@ -5,10 +5,19 @@
 Author: Zhou Ya'nan
 Date: 2021-09-16
 """
-
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import geopandas as gpd
+import rasterio
+from rasterio.features import geometry_mask, geometry_window, rasterize
+from rasterio.errors import WindowError
+from rasterio.windows import Window
+import shapely
+from shapely.geometry import box
 from rasterstats import zonal_stats
 
+from util_lib import init_worker_dataset, iter_block_windows, read_feature_batches, worker_dataset, write_feature_batches
+
 
 """
 从rasterstats库的源码来看，其基本上是模仿了ArcGIS的分区统计工具。因此相对于QGIS，其实现的并不好。
@@ -19,7 +28,7 @@ raster_stats(vectors, raster, layer_num=0, band_num=1, nodata_value=None,
 """
 
 
-def zonal_statistics_rasterstats(input_shp, input_raster, output_shp, stats=["mean", "min", "max", "median"]):
+def zonal_statistics_rasterstats(input_shp, input_raster, output_shp, stats=["mean", "min", "max", "median"], batch_size=None):
     """
     Summarizes the values of a raster within the zones of another dataset.
 
@@ -28,20 +37,303 @@ def zonal_statistics_rasterstats(input_shp, input_raster, output_shp, stats=["me
     input_raster (str): The path to the input raster file.
     output_shp (str): The path to the output shapefile.
     stats (list): A list of statistics to calculate. Optional values include 'mean', 'min', 'max', 'median', 'sum', 'std', etc.
+    batch_size (int): The number of polygons read, summarized and written at once. Default is None, i.e. the whole layer at once.
 
     Returns:
     result (str): The path to the output shapefile containing the calculated statistics.
     """
 
+    def summarize_batches():
+        # Read the shapefile, batch by batch
+        for shapes in read_feature_batches(input_shp, batch_size):
+            # Calculate zonal statistics
+            results = zonal_stats(shapes, input_raster, stats=stats, geojson_out=True)
+
+            # Append the statistics to the GeoDataFrame
+            for stat in stats:
+                shapes[stat] = [result['properties'][stat] for result in results]
+            yield shapes
+        # for
+
+    # Save the result to a new shapefile
+    write_feature_batches(summarize_batches(), output_shp)
+
+    return output_shp
+
+
+# 自行实现的分区统计支持的统计量（与rasterstats同名，percentile_<q>为任意百分位数）
+ZONAL_STATS = ['count', 'min', 'max', 'mean', 'sum', 'std', 'median', 'range']
+
+
+def _check_stats(stats):
+    """
+    Check that the statistics are supported by the native engines.
+    """
+    for stat in stats:
+        if stat not in ZONAL_STATS and not stat.startswith('percentile_'):
+            raise ValueError(f"Unsupported statistic: {stat}")
+
+
+def _stats_from_values(values, stats):
+    """
+    Compute the statistics of the valid pixel values of one zone, with the output of rasterstats:
+    None for every statistic of an empty zone, except 'count' which is 0.
+    """
+    if values.size == 0:
+        return {stat: (0 if stat == 'count' else None) for stat in stats}
+
+    # 整型累加时使用int64，避免溢出（均值再按浮点数计算，不能截断）
+    integer = np.issubdtype(values.dtype, np.integer)
+    result = {}
+    for stat in stats:
+        if stat == 'count':
+            result[stat] = int(values.size)
+        elif stat == 'min':
+            result[stat] = float(values.min())
+        elif stat == 'max':
+            result[stat] = float(values.max())
+        elif stat == 'mean':
+            result[stat] = float(values.sum(dtype=np.int64) / values.size) if integer else float(values.mean())
+        elif stat == 'sum':
+            result[stat] = float(values.sum(dtype=np.int64 if integer else None))
+        elif stat == 'std':
+            result[stat] = float(values.std())
+        elif stat == 'median':
+            result[stat] = float(np.median(values))
+        elif stat == 'range':
+            result[stat] = float(values.max()) - float(values.min())
+        else:
+            result[stat] = float(np.percentile(values, float(stat[len('percentile_'):])))
+    # for
+
+    return result
+
+
+def _zone_values(src, geom, band=1, all_touched=False):
+    """
+    Read the valid pixel values inside one polygon, reading only the window of its bounding box.
+    """
+    if geom is None or geom.is_empty:
+        return np.empty(0, dtype=src.dtypes[band - 1])
+    try:
+        win = geometry_window(src, [geom])
+    except WindowError:
+        # 多边形与栅格不相交
+        return np.empty(0, dtype=src.dtypes[band - 1])
+
+    data = src.read(band, window=win)
+    inside = geometry_mask([geom], out_shape=data.shape, transform=src.window_transform(win), invert=True, all_touched=all_touched)
+
+    # 排除NoData和NaN
+    if src.nodata is not None:
+        inside &= data != src.nodata
+    if np.issubdtype(data.dtype, np.floating):
+        inside &= ~np.isnan(data)
+
+    return data[inside]
+
+
+def _weighted_stats_from_values(values, weights, stats):
+    """
+    Compute the coverage-weighted statistics of one zone, as QgsZonalStatistics:
+    count and sum are weighted, mean and std are weighted by the cell coverage, min and max are taken
+    over the cells with a positive weight, median and percentiles are weighted percentiles.
+    """
+    keep = weights > 0
+    values = values[keep].astype(np.float64)
+    weights = weights[keep]
+    if values.size == 0:
+        return {stat: (0 if stat == 'count' else None) for stat in stats}
+
+    total = float(weights.sum())
+    mean = float((weights * values).sum() / total)
+    result = {}
+    for stat in stats:
+        if stat == 'count':
+            result[stat] = total
+        elif stat == 'min':
+            result[stat] = float(values.min())
+        elif stat == 'max':
+            result[stat] = float(values.max())
+        elif stat == 'mean':
+            result[stat] = mean
+        elif stat == 'sum':
+            result[stat] = float((weights * values).sum())
+        elif stat == 'std':
+            result[stat] = float(np.sqrt((weights * (values - mean) ** 2).sum() / total))
+        elif stat == 'range':
+            result[stat] = float(values.max() - values.min())
+        else:
+            # 加权百分位数：累计权重首次达到q%时的值
+            q = 50 if stat == 'median' else float(stat[len('percentile_'):])
+            order = np.argsort(values, kind='stable')
+            cum_weights = np.cumsum(weights[order])
+            k = min(int(np.searchsorted(cum_weights, q / 100 * total, side='left')), len(order) - 1)
+            result[stat] = float(values[order[k]])
+    # for
+
+    return result
+
+
+def _zone_coverage_values(src, geom, band=1, weighting='coverage'):
+    """
+    Read the valid pixel values inside one polygon together with the fraction of each cell covered by the polygon.
+
+    The exact covered fraction is computed with vectorised geometry ops only for the boundary cells
+    (cells crossed by the polygon outline); interior cells have a weight of 1.
+
+    weighting='coverage' uses these weights for every polygon.
+    weighting='qgis' follows QgsZonalStatistics: the cells whose center is inside get a weight of 1,
+    and the coverage weights are only used when fewer than two cell centers are inside the polygon.
+    """
+    empty = np.empty(0, dtype=src.dtypes[band - 1]), np.empty(0)
+    if geom is None or geom.is_empty:
+        return empty
+    try:
+        win = geometry_window(src, [geom])
+    except WindowError:
+        # 多边形与栅格不相交
+        return empty
+
+    data = src.read(band, window=win)
+    win_transform = src.window_transform(win)
+    centers = geometry_mask([geom], out_shape=data.shape, transform=win_transform, invert=True)
+
+    if weighting == 'qgis' and centers.sum() >= 2:
+        weights = centers.astype(np.float64)
+    else:
+        # 边界穿过的像元：精确计算像元与多边形相交的面积比例
+        boundary = geometry_mask([geom.boundary], out_shape=data.shape, transform=win_transform, invert=True, all_touched=True)
+        weights = (centers & ~boundary).astype(np.float64)
+        rows, cols = np.nonzero(boundary)
+        x0 = win_transform.c + cols * win_transform.a
+        y0 = win_transform.f + rows * win_transform.e
+        x1 = x0 + win_transform.a
+        y1 = y0 + win_transform.e
+        cells = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+        shapely.prepare(geom)
+        weights[rows, cols] = shapely.area(shapely.intersection(cells, geom)) / abs(win_transform.a * win_transform.e)
+
+    # 排除NoData和NaN
+    valid = weights > 0
+    if src.nodata is not None:
+        valid &= data != src.nodata
+    if np.issubdtype(data.dtype, np.floating):
+        valid &= ~np.isnan(data)
+
+    return data[valid], weights[valid]
+
+
+def _zone_stats(src, geom, stats, band=1, all_touched=False, weighting='center'):
+    """
+    Compute the statistics of one polygon with the given cell weighting.
+    """
+    if weighting == 'center':
+        return _stats_from_values(_zone_values(src, geom, band, all_touched), stats)
+    if weighting in ('coverage', 'qgis'):
+        return _weighted_stats_from_values(*_zone_coverage_values(src, geom, band, weighting), stats)
+    raise ValueError(f"Unknown weighting: {weighting}")
+
+
+def _zonal_chunk(job):
+    """
+    Compute the statistics of one chunk of polygons in a worker process.
+    """
+    indices, geoms, stats, band, all_touched, weighting = job
+    return indices, [_zone_stats(worker_dataset(), geom, stats, band, all_touched, weighting) for geom in geoms]
+
+
+def _spread_bits(v):
+    """
+    Insert a zero bit between each of the 16 lower bits of v, for the Morton code.
+    """
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+    return v
+
+
+def _spatial_chunks(geoms, chunk_size=1000):
+    """
+    Partition the polygons into spatially coherent chunks, following the Morton (Z-order) curve over the bounding-box centers.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        The indices of the polygons of each chunk.
+    """
+    bounds = shapely.bounds(geoms)
+    xs = (bounds[:, 0] + bounds[:, 2]) / 2
+    ys = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    # 中心点量化到16位网格，空几何（NaN）放在最前面
+    def quantize(v):
+        finite = np.isfinite(v)
+        if not finite.any():
+            return np.zeros(len(v), dtype=np.uint64)
+        v_min, v_max = v[finite].min(), v[finite].max()
+        q = np.zeros(len(v), dtype=np.uint64)
+        q[finite] = ((v[finite] - v_min) / max(v_max - v_min, 1e-12) * 65535).astype(np.uint64)
+        return q
+
+    codes = _spread_bits(quantize(xs)) | (_spread_bits(quantize(ys)) << np.uint64(1))
+    order = np.argsort(codes, kind='stable')
+
+    return [order[i:i + chunk_size] for i in range(0, len(order), chunk_size)]
+
+
+def zonal_statistics_native(input_shp, input_raster, output_shp, stats=["mean", "min", "max", "median"], band=1, all_touched=False, weighting='center',
+                            workers=None, chunk_size=1000):
+    """
+    Summarizes the values of a raster within the zones of another dataset, without rasterstats.
+
+    Each polygon is rasterized only over its bounding-box window, only this window is read,
+    and the statistics are computed with NumPy reductions. The output schema is the same as zonal_statistics_rasterstats.
+
+    Parameters:
+    input_shp (str): The path to the input shapefile.
+    input_raster (str): The path to the input raster file.
+    output_shp (str): The path to the output shapefile.
+    stats (list): A list of statistics to calculate: 'count', 'min', 'max', 'mean', 'sum', 'std', 'median', 'range', 'percentile_<q>'.
+    band (int): The band of the raster. Default is 1.
+    all_touched (bool): Include all the cells touched by the polygons, not only those whose center is inside. Default is False.
+    weighting (str): How the cells are weighted. Default is 'center'.
+        'center': the cells whose center is inside (or touched, see all_touched) have a weight of 1, as rasterstats and ArcGIS.
+        'coverage': each cell is weighted by the exact fraction covered by the polygon, which is more accurate for small polygons.
+        'qgis': the rule of QgsZonalStatistics, coverage weights only for the polygons containing fewer than two cell centers.
+    workers (int): The number of worker processes. The polygons are partitioned into spatially coherent chunks
+        (Z-order of their centers), each worker opening its own raster handle. Default is None, i.e. serially.
+    chunk_size (int): The number of polygons of each chunk. Default is 1000.
+
+    Returns:
+    result (str): The path to the output shapefile containing the calculated statistics.
+    """
+    _check_stats(stats)
+
     # Read the shapefile
     shapes = gpd.read_file(input_shp)
 
-    # Calculate zonal statistics
-    results = zonal_stats(shapes, input_raster, stats=stats, geojson_out=True)
+    # Calculate zonal statistics, polygon by polygon
+    if workers is None or workers <= 1:
+        with rasterio.open(input_raster) as src:
+            results = [_zone_stats(src, geom, stats, band, all_touched, weighting) for geom in shapes.geometry]
+    else:
+        # 按空间分块并行计算，相邻的多边形读取相邻的栅格块，再按输入顺序重组结果
+        geoms = shapes.geometry.values
+        jobs = [(indices, geoms[indices], stats, band, all_touched, weighting) for indices in _spatial_chunks(geoms, chunk_size)]
+        results = [None] * len(shapes)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_dataset, initargs=(input_raster,)) as executor:
+            for indices, chunk_results in executor.map(_zonal_chunk, jobs):
+                for idx, result in zip(indices, chunk_results):
+                    results[idx] = result
+                # for
+            # for
+        # with
 
     # Append the statistics to the GeoDataFrame
     for stat in stats:
-        shapes[stat] = [result['properties'][stat] for result in results]
+        shapes[stat] = [result[stat] for result in results]
 
     # Save the result to a new shapefile
     shapes.to_file(output_shp)
@@ -49,4 +341,120 @@ def zonal_statistics_rasterstats(input_shp, input_raster, output_shp, stats=["me
     return output_shp
 
 
-# TODO: 如果有时间，还是自己实现zonal statistics, 参考QGIS的实现方式提高精度，是否可以调用gdal库提升计算效率？
+def zonal_statistics_zone_grid(input_shp, input_raster, output_shp, stats=["mean", "min", "max", "median"], band=1, all_touched=False):
+    """
+    Summarizes the values of a raster within the zones of another dataset, in a single pass over the raster.
+
+    The zone IDs are burnt block by block into an integer grid aligned to the value raster, and the statistics
+    are accumulated per zone with grouped reductions (np.bincount, np.minimum.at, ...), so the cost is one pass
+    over the raster whatever the number of polygons. It suits layers of many small polygons.
+    Overlapping polygons are not supported: a cell covered by several polygons is only counted in the last one.
+
+    Parameters:
+    input_shp (str): The path to the input shapefile.
+    input_raster (str): The path to the input raster file.
+    output_shp (str): The path to the output shapefile.
+    stats (list): A list of statistics to calculate: 'count', 'min', 'max', 'mean', 'sum', 'std', 'median', 'range', 'percentile_<q>'.
+    band (int): The band of the raster. Default is 1.
+    all_touched (bool): Include all the cells touched by the polygons, not only those whose center is inside. Default is False.
+
+    Returns:
+    result (str): The path to the output shapefile containing the calculated statistics.
+    """
+    _check_stats(stats)
+    need_values = any(stat == 'median' or stat.startswith('percentile_') for stat in stats)
+
+    # Read the shapefile
+    shapes = gpd.read_file(input_shp)
+    n_zones = len(shapes)
+    geoms = shapes.geometry.values
+    sindex = shapes.sindex
+
+    # 分区号从1开始，0表示不在任何分区内
+    counts = np.zeros(n_zones + 1, dtype=np.int64)
+    sums = np.zeros(n_zones + 1)
+    sq_sums = np.zeros(n_zones + 1)
+    mins = np.full(n_zones + 1, np.inf)
+    maxs = np.full(n_zones + 1, -np.inf)
+    zone_values = [[] for _ in range(n_zones + 1)] if need_values else None
+    shift = None
+
+    with rasterio.open(input_raster) as src:
+        block_height, block_width = src.block_shapes[band - 1]
+        for win in iter_block_windows(src.width, src.height, block_width, block_height):
+            win = Window(*win)
+            # 只栅格化与当前块相交的多边形
+            win_transform = src.window_transform(win)
+            zone_idx = sindex.query(box(*rasterio.windows.bounds(win, src.transform)))
+            zone_idx = [k for k in zone_idx if geoms[k] is not None and not geoms[k].is_empty]
+            if len(zone_idx) == 0:
+                continue
+            zone_idx.sort()
+            zone_grid = rasterize(((geoms[k], k + 1) for k in zone_idx), out_shape=(int(win.height), int(win.width)),
+                                  transform=win_transform, fill=0, all_touched=all_touched, dtype='int32')
+
+            data = src.read(band, window=win)
+            valid = zone_grid > 0
+            if src.nodata is not None:
+                valid &= data != src.nodata
+            if np.issubdtype(data.dtype, np.floating):
+                valid &= ~np.isnan(data)
+            zones = zone_grid[valid]
+            values = data[valid]
+            if values.size == 0:
+                continue
+
+            # 平方和以第一块的均值为参考，减小方差计算的舍入误差
+            if shift is None:
+                shift = float(values.mean(dtype=np.float64))
+            shifted = values.astype(np.float64) - shift
+
+            counts += np.bincount(zones, minlength=n_zones + 1)
+            sums += np.bincount(zones, weights=values.astype(np.float64), minlength=n_zones + 1)
+            sq_sums += np.bincount(zones, weights=shifted * shifted, minlength=n_zones + 1)
+            np.minimum.at(mins, zones, values)
+            np.maximum.at(maxs, zones, values)
+
+            if need_values:
+                order = np.argsort(zones, kind='stable')
+                sorted_zones = zones[order]
+                starts = np.flatnonzero(np.r_[True, sorted_zones[1:] != sorted_zones[:-1]])
+                for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+                    zone_values[sorted_zones[start]].append(values[order[start:end]])
+                # for
+        # for
+    # with
+
+    # Append the statistics to the GeoDataFrame, null for the empty zones (0 for 'count')
+    counts, sums, sq_sums, mins, maxs = counts[1:], sums[1:], sq_sums[1:], mins[1:], maxs[1:]
+    empty = counts == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        stds = np.sqrt(np.maximum(0, sq_sums / counts - (means - (shift or 0)) ** 2))
+
+    for stat in stats:
+        if stat == 'count':
+            shapes[stat] = counts
+            continue
+        if stat == 'min':
+            column = mins
+        elif stat == 'max':
+            column = maxs
+        elif stat == 'mean':
+            column = means
+        elif stat == 'sum':
+            column = sums
+        elif stat == 'std':
+            column = stds
+        elif stat == 'range':
+            column = maxs - mins
+        else:
+            q = 50 if stat == 'median' else float(stat[len('percentile_'):])
+            column = np.array([np.percentile(np.concatenate(v), q) if v else np.nan for v in zone_values[1:]])
+        shapes[stat] = np.where(empty, np.nan, column)
+    # for
+
+    # Save the result to a new shapefile
+    shapes.to_file(output_shp)
+
+    return output_shp
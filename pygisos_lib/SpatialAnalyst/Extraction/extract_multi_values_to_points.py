@@ -5,8 +5,171 @@
 Author: Zhou Ya'nan
 Date: 2021-09-16
 """
+import os
+import csv
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import pandas as pd
 import geopandas as gpd
 import rasterio
 
+from util_lib import gdal_driver_by_file_extension
+from .extract_values_to_points import _BlockCache, _points_to_pixels, _sample_pixels, _value_column
 
 
+"""
+from ArcGIS
+Extract Multi Values to Points: Extracts cell values at locations specified in a point feature class
+from one or more rasters, and records the values to the attribute table of the point feature class.
+"""
+
+# 各格式字段名的最大长度（Shapefile的dBASE表为10个字符，更长的字段名会被截断，截断后可能重名）
+MAX_FIELD_NAME_LENGTH = {'ESRI Shapefile': 10}
+
+
+def _raster_fields(field_name, band_count):
+    """
+    The output fields of a raster: the field name, or one field per band suffixed with '_b<band>'.
+    """
+    if band_count == 1:
+        return [field_name]
+    return [f'{field_name}_b{band}' for band in range(1, band_count + 1)]
+
+
+def _check_output_fields(raster_fields, point_fields, driver):
+    """
+    Check that the output fields fit the field name length of the driver, and are unique (case-insensitive)
+    among themselves and the fields of the points.
+    """
+    fields = [field for fields in raster_fields for field in fields]
+    max_length = MAX_FIELD_NAME_LENGTH.get(driver)
+    too_long = [field for field in fields if max_length and len(field) > max_length]
+    if too_long:
+        raise ValueError(f"The field names {too_long} are longer than the {max_length} characters of the {driver} format.")
+
+    names = [field.lower() for field in fields + list(point_fields)]
+    if len(set(names)) != len(names):
+        raise ValueError("The field names of the input rasters are not unique, or collide with the fields of the points.")
+
+
+def _write_field_mapping(output_shp, input_rasters, raster_fields):
+    """
+    Write the mapping from the output fields to the rasters, '<output name>_fields.csv' next to the output.
+    """
+    mapping_file = os.path.splitext(output_shp)[0] + '_fields.csv'
+    with open(mapping_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['field', 'raster', 'band'])
+        for input_raster, fields in zip(input_rasters, raster_fields):
+            for band, field in enumerate(fields, start=1):
+                writer.writerow([field, input_raster, band])
+        # for
+    # with
+
+    return mapping_file
+
+
+def extract_multi_values_to_points(input_rasters: List[str], input_shp: str, output_shp: str, field_names: Optional[List[str]] = None,
+                                   method: str = 'nearest', workers: int = 8, cache_blocks: int = 64) -> str:
+    """
+    Extract values from many rasters (e.g. a time series) to points, writing one wide attribute table.
+
+    The raster indices of the points are computed once per distinct grid (rasters sharing the transform
+    and the shape reuse them), the rasters are sampled concurrently in a thread pool, reading only the
+    blocks containing points, and the output is written once.
+
+    Parameters
+    ----------
+    input_rasters: list of str
+        The input raster files, in the same coordinate system as the points.
+    input_shp: str
+        The input shapefile containing points.
+    output_shp: str
+        The output shapefile where the extracted values will be stored.
+    field_names: list of str, optional
+        The field name of each raster. Multi-band rasters get one field per band, suffixed with '_b<band>'.
+        If None, the raster file names (without extension) are used; when they do not fit the output format
+        (longer than the 10 characters of a shapefile field), the fields are named r1, r2, ... instead,
+        and their mapping to the rasters is written to '<output name>_fields.csv'.
+        Given names which do not fit the output format raise a ValueError.
+    method: str, optional
+        The interpolation method, 'nearest', 'bilinear' or 'cubic'. Default is 'nearest'.
+    workers: int, optional
+        The number of threads sampling the rasters. Default is 8.
+    cache_blocks: int, optional
+        The number of raster blocks kept in the LRU cache of each raster. Default is 64.
+
+    Returns
+    -------
+    str
+        The file path of the output shapefile.
+    """
+    for input_raster in input_rasters:
+        if not os.path.exists(input_raster):
+            raise FileNotFoundError(f"The input raster file '{input_raster}' does not exist.")
+    if not os.path.exists(input_shp):
+        raise FileNotFoundError(f"The input shapefile '{input_shp}' does not exist.")
+
+    if field_names is not None and len(field_names) != len(input_rasters):
+        raise ValueError("The number of field names does not match the number of input rasters.")
+
+    # Load the points shapefile
+    points = gpd.read_file(input_shp)
+    point_fields = [column for column in points.columns if column != points.geometry.name]
+
+    # 检查输出字段名，截断的字段名会重名或与原字段混淆
+    band_counts = []
+    for input_raster in input_rasters:
+        with rasterio.open(input_raster) as src:
+            band_counts.append(src.count)
+    # for
+    driver = gdal_driver_by_file_extension(output_shp)
+    short_names = False
+    if field_names is None:
+        field_names = [os.path.splitext(os.path.basename(f))[0] for f in input_rasters]
+        try:
+            _check_output_fields([_raster_fields(*args) for args in zip(field_names, band_counts)], point_fields, driver)
+        except ValueError:
+            field_names = [f'r{k}' for k in range(1, len(input_rasters) + 1)]
+            short_names = True
+    raster_fields = [_raster_fields(*args) for args in zip(field_names, band_counts)]
+    _check_output_fields(raster_fields, point_fields, driver)
+    xs = points.geometry.x.to_numpy()
+    ys = points.geometry.y.to_numpy()
+
+    # 相同格网（仿射变换和行列数相同）的栅格共用点的行列号
+    pixel_cache = {}
+    pixel_lock = threading.Lock()
+
+    def sample_raster(input_raster, fields):
+        with rasterio.open(input_raster) as src:
+            grid = (tuple(src.transform)[:6], src.width, src.height)
+            with pixel_lock:
+                if grid not in pixel_cache:
+                    pixel_cache[grid] = _points_to_pixels(src.transform, xs, ys)
+                rows, cols = pixel_cache[grid]
+            # with
+
+            bands = list(range(1, src.count + 1))
+            values, valid = _sample_pixels(_BlockCache(src, bands, cache_blocks), rows, cols, method)
+            dtypes = [src.dtypes[band - 1] for band in bands]
+        # with
+
+        return {field: _value_column(values[k], dtypes[k], method) for k, field in enumerate(fields)}
+
+    # Sample the rasters concurrently, the results keep the order of the input rasters
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(sample_raster, input_rasters, raster_fields))
+
+    # Build the wide attribute table at once, and save the result as a new shapefile
+    columns = {}
+    for result in results:
+        columns.update(result)
+    values_df = pd.DataFrame(columns, index=points.index)
+    points = gpd.GeoDataFrame(pd.concat([points, values_df], axis=1), geometry=points.geometry.name, crs=points.crs)
+    points.to_file(output_shp)
+    if short_names:
+        _write_field_mapping(output_shp, input_rasters, raster_fields)
+
+    return output_shp
@@ -6,16 +6,211 @@ Author: Zhou Ya'nan
 Date: 2021-09-16
 """
 import os
+from collections import OrderedDict
 from typing import List, Optional
-import geopandas as gpd
+import numpy as np
+import pandas as pd
 import rasterio
+from rasterio.windows import Window
 
+from util_lib import read_feature_batches, write_feature_batches
 
-def extract_raster_values_to_points(input_raster: str, input_shp: str, output_shp: str, bands: Optional[List[int]] = None) -> str:
+
+class _BlockCache:
+    """
+    LRU cache of the native blocks of a raster, each block holding all requested bands.
+    """
+
+    def __init__(self, src, bands, max_blocks=64):
+        self.src = src
+        self.bands = bands
+        self.max_blocks = max(1, max_blocks)
+        self.block_height, self.block_width = src.block_shapes[bands[0] - 1]
+        self.n_block_cols = -(-src.width // self.block_width)
+        self.blocks = OrderedDict()
+
+    def block_ids(self, rows, cols):
+        """
+        The block id of each pixel (row, col).
+        """
+        return (rows // self.block_height) * self.n_block_cols + cols // self.block_width
+
+    def get(self, block_id):
+        """
+        The array (bands, rows, cols) of a block, read on the first access.
+        """
+        if block_id in self.blocks:
+            self.blocks.move_to_end(block_id)
+            return self.blocks[block_id]
+
+        block_row, block_col = divmod(block_id, self.n_block_cols)
+        row_off = block_row * self.block_height
+        col_off = block_col * self.block_width
+        win = Window(col_off, row_off, min(self.block_width, self.src.width - col_off), min(self.block_height, self.src.height - row_off))
+        block = self.src.read(self.bands, window=win)
+
+        self.blocks[block_id] = block
+        if len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+        return block
+
+    def gather(self, rows, cols):
+        """
+        The values (bands, n) of the pixels (rows, cols), reading only the blocks containing them.
+        """
+        out = np.empty((len(self.bands), len(rows)), dtype=self.src.dtypes[self.bands[0] - 1])
+        block_ids = self.block_ids(rows, cols)
+
+        # 按块分组，每个块只读取（或从缓存获取）一次
+        order = np.argsort(block_ids, kind='stable')
+        sorted_ids = block_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+            idx = order[start:end]
+            block_id = int(sorted_ids[start])
+            block = self.get(block_id)
+            block_row, block_col = divmod(block_id, self.n_block_cols)
+            out[:, idx] = block[:, rows[idx] - block_row * self.block_height, cols[idx] - block_col * self.block_width]
+        # for
+
+        return out
+
+
+def _linear_kernel(t):
+    """
+    Weights of the bilinear interpolation at distance t.
+    """
+    return np.maximum(0, 1 - np.abs(t))
+
+
+def _cubic_kernel(t, a=-0.5):
+    """
+    Weights of the cubic convolution (Keys) interpolation at distance t.
+    """
+    t = np.abs(t)
+    return np.where(t <= 1, (a + 2) * t ** 3 - (a + 3) * t ** 2 + 1,
+                    np.where(t < 2, a * t ** 3 - 5 * a * t ** 2 + 8 * a * t - 4 * a, 0))
+
+
+# 插值方法：(相对于左上像元的偏移, 权重函数)
+_INTERPOLATION_KERNELS = {
+    'bilinear': ((0, 1), _linear_kernel),
+    'cubic': ((-1, 0, 1, 2), _cubic_kernel),
+}
+
+
+def _valid_pixels(values, nodata):
+    """
+    Mask of the values which are not NoData.
+    """
+    if nodata is None:
+        return np.ones(values.shape, dtype=bool)
+    if np.isnan(nodata):
+        return ~np.isnan(values)
+    return values != nodata
+
+
+def _points_to_pixels(transform, xs, ys):
+    """
+    Convert the coordinates of all points to fractional raster indices (rows, cols) at once.
+    """
+    cols, rows = ~transform * (xs, ys)
+    return rows, cols
+
+
+def _sample_pixels(cache, rows, cols, method='nearest'):
+    """
+    Sample the bands of an opened raster at fractional raster indices, reading only the blocks containing points.
+
+    Parameters
+    ----------
+    cache: _BlockCache
+        The block cache of the opened raster and the bands to sample, shared by the successive batches of points.
+    rows, cols: numpy.ndarray
+        The fractional raster indices of the points, see _points_to_pixels.
+    method: str, optional
+        'nearest', 'bilinear' or 'cubic'. Default is 'nearest'.
+
+    Returns
+    -------
+    tuple
+        (values, valid), the float64 array (bands, n) of the sampled values and its mask.
+        The points out of extent or on NoData (any NoData neighbour for the interpolations) are not valid.
+    """
+    src, bands = cache.src, cache.bands
+    nodata = src.nodata
+    values = np.full((len(bands), len(rows)), np.nan)
+    valid = np.zeros((len(bands), len(rows)), dtype=bool)
+
+    # Check if the indices are within the raster extent (NaN coordinates of empty points are outside)
+    inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+    inside_idx = np.flatnonzero(inside)
+
+    if method == 'nearest':
+        pixels = cache.gather(np.floor(rows[inside_idx]).astype(np.int64), np.floor(cols[inside_idx]).astype(np.int64))
+        values[:, inside_idx] = pixels
+        valid[:, inside_idx] = _valid_pixels(pixels, nodata)
+    elif method in _INTERPOLATION_KERNELS:
+        offsets, kernel = _INTERPOLATION_KERNELS[method]
+
+        # 像元中心位于(行+0.5, 列+0.5)，邻域超出影像时取边缘像元
+        pixel_rows = rows[inside_idx] - 0.5
+        pixel_cols = cols[inside_idx] - 0.5
+        base_rows = np.floor(pixel_rows).astype(np.int64)
+        base_cols = np.floor(pixel_cols).astype(np.int64)
+
+        # 按左上像元所在的块分组，邻域像元多数落在同一块或相邻块中，可命中缓存
+        base_ids = cache.block_ids(np.clip(base_rows, 0, src.height - 1), np.clip(base_cols, 0, src.width - 1))
+        order = np.argsort(base_ids, kind='stable')
+        sorted_ids = base_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+            idx = order[start:end]
+            acc = np.zeros((len(bands), len(idx)))
+            ok = np.ones((len(bands), len(idx)), dtype=bool)
+            for a in offsets:
+                row_weights = kernel(pixel_rows[idx] - (base_rows[idx] + a))
+                neighbour_rows = np.clip(base_rows[idx] + a, 0, src.height - 1)
+                for b in offsets:
+                    col_weights = kernel(pixel_cols[idx] - (base_cols[idx] + b))
+                    neighbour_cols = np.clip(base_cols[idx] + b, 0, src.width - 1)
+                    pixels = cache.gather(neighbour_rows, neighbour_cols)
+                    ok &= _valid_pixels(pixels, nodata)
+                    acc += pixels * (row_weights * col_weights)
+                # for
+            # for
+            values[:, inside_idx[idx]] = acc
+            valid[:, inside_idx[idx]] = ok
+        # for
+    else:
+        raise ValueError(f"Unknown interpolation method: {method}")
+
+    values[~valid] = np.nan
+
+    return values, valid
+
+
+def _value_column(values, dtype, method='nearest'):
+    """
+    Build the attribute column of sampled values, with nulls for the NaN values.
+    Integer bands sampled with 'nearest' are kept as nullable integers, instead of floats or strings.
+    """
+    if method == 'nearest' and np.issubdtype(np.dtype(dtype), np.integer):
+        return pd.array(values, dtype='Int64')
+
+    return values
+
+
+def extract_raster_values_to_points(input_raster: str, input_shp: str, output_shp: str, bands: Optional[List[int]] = None,
+                                    method: str = 'nearest', cache_blocks: int = 64, batch_size: Optional[int] = None) -> str:
     """
     Extract values from multiple bands of a raster to points.
     The raster values will be stored in new fields named 'band_1', 'band_2', etc., in the output shapefile.
 
+    Only the raster blocks containing points are read, so the memory cost depends on the point footprint
+    instead of the raster size.
+
     Parameters
     ----------
     input_raster: str
@@ -27,6 +222,12 @@ def extract_raster_values_to_points(input_raster: str, input_shp: str, output_sh
     bands: list of int, optional
         A list of integers representing band indices to extract values from.
         If None, values from all bands will be extracted.
+    method: str, optional
+        The interpolation method, 'nearest', 'bilinear' or 'cubic'. Default is 'nearest'.
+    cache_blocks: int, optional
+        The number of raster blocks kept in the LRU cache. Default is 64.
+    batch_size: int, optional
+        The number of points read, sampled and written at once. Default is None, i.e. the whole layer at once.
 
     Returns
     -------
@@ -38,42 +239,31 @@ def extract_raster_values_to_points(input_raster: str, input_shp: str, output_sh
     if not os.path.exists(input_shp):
         raise FileNotFoundError(f"The input shapefile '{input_shp}' does not exist.")
 
-    # Load the points shapefile
-    if bands is None:
-        bands = []
-    points = gpd.read_file(input_shp)
-
     # Load the raster file
     with rasterio.open(input_raster) as src:
-        # Extract the affine transformation and data of the raster
-        affine = src.transform
-        raster_data = src.read()  # Read all bands of the raster
-
-        # Prepare a list to save the raster values for each point
-        values = {f'band_{band}': [] for band in bands} if bands else {f'band_{i + 1}': [] for i in range(src.count)}
-
-        # Iterate over each point
-        for geom in points.geometry:
-            # Get the coordinates of the point
-            x, y = geom.x, geom.y
-            # Convert the coordinates to raster indices (row, col)
-            row, col = ~affine * (x, y)
-            row, col = int(row), int(col)
-
-            # Check if the indices are within the raster extent
-            if 0 <= row < raster_data.shape[1] and 0 <= col < raster_data.shape[2]:
-                for band in bands:
-                    value = raster_data[band - 1, row, col]  # Get the raster value
-                    values[f'band_{band}'].append(value)
-            else:
-                for band in bands:
-                    values[f'band_{band}'].append(None)  # Assign None if out of extent
-
-    # Add the extracted raster values as new columns to the vector data
-    for band, value_list in values.items():
-        points[band] = value_list
-
-    # Save the result as a new shapefile
-    points.to_file(output_shp)
+        if not bands:
+            bands = list(range(1, src.count + 1))
+        dtypes = [src.dtypes[band - 1] for band in bands]
+        # 块缓存在各批次之间共用，跨批次的点所在的块不重复读取
+        cache = _BlockCache(src, bands, cache_blocks)
+
+        def sample_batches():
+            # Load the points shapefile, batch by batch
+            for points in read_feature_batches(input_shp, batch_size):
+                # Convert the coordinates of all points to raster indices (row, col) at once
+                rows, cols = _points_to_pixels(src.transform, points.geometry.x.to_numpy(), points.geometry.y.to_numpy())
+
+                # Sample the blocks containing points, null is assigned to the points out of extent or on NoData
+                values, valid = _sample_pixels(cache, rows, cols, method)
+
+                # Add the extracted raster values as new columns to the vector data
+                for k, band in enumerate(bands):
+                    points[f'band_{band}'] = _value_column(values[k], dtypes[k], method)
+                yield points
+            # for
+
+        # Save the result as a new shapefile
+        write_feature_batches(sample_batches(), output_shp)
+    # with
 
     return output_shp
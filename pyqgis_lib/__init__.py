@@ -135,6 +135,9 @@ from .GeoAnalytics import buffer
 
 from .RasterAnalyst import zonal_statistics
 
+# 常驻的 QGIS 工作进程池，批量任务并行执行，每个进程只初始化一次 QGIS
+from .worker_pool import QGISWorkerPool
+
 """
 调用PYQGIS算法的两种方式：
 1. 使用processing.run()方法
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+pyqgis
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+"""
+QGIS 工作进程池：
+启动QgsApplication、初始化Processing并注册算法提供者需要数秒，如果每个任务都启动一次QGIS，启动时间会远大于算法时间。
+进程池中的每个工作进程在initializer中只初始化一次QGIS环境（导入pyqgis_lib即完成初始化），之后常驻，
+通过进程池的任务队列接收processing.run任务，每个任务只付出算法本身的时间，多个任务并行执行。
+
+工作进程以spawn方式启动，不继承主进程中的QGIS对象（QGIS对象在fork后不可用）。
+
+    from pyqgis_lib import QGISWorkerPool
+    with QGISWorkerPool(workers=4) as pool:
+        jobs = [{'INPUT': f, 'DISTANCE': 500, 'OUTPUT': f.replace('.shp', '_buffer.shp')} for f in input_files]
+        results = pool.map("native:buffer", jobs)
+"""
+
+
+def _init_qgis_worker():
+    """
+    工作进程的初始化函数：导入pyqgis_lib，由QGISAlgorithmManager单例初始化QGIS环境，每个进程只执行一次。
+    """
+    import pyqgis_lib  # noqa: F401
+
+
+def _picklable_result(value):
+    """
+    将算法输出转换为可在进程间传递的值，QGIS对象（如内存图层）转换为字符串。
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_picklable_result(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _picklable_result(v) for k, v in value.items()}
+    return str(value)
+
+
+def _run_algorithm(algorithm, parameters):
+    """
+    在工作进程中运行一个Processing算法。
+    :param algorithm: 算法id，如 "native:buffer"
+    :param parameters: 算法参数
+    :return: 算法输出参数的字典
+    """
+    from qgis.core import (QgsProcessingContext, QgsProcessingFeedback)
+    import processing
+
+    # Initialize the feedback and the processing context for each job
+    feedback = QgsProcessingFeedback()
+    context = QgsProcessingContext()
+    context.setFeedback(feedback)
+
+    try:
+        result = processing.run(algorithm, parameters, context=context, feedback=feedback)
+    except Exception as e:
+        # QGIS的异常对象不一定能序列化，转换为RuntimeError返回主进程
+        raise RuntimeError(f"{algorithm} failed: {e}") from None
+
+    return _picklable_result(result)
+
+
+def _run_function(func, args, kwargs):
+    """
+    在工作进程中运行一个封装函数（如 pyqgis_lib 中各算法模块的 run 函数）。
+    """
+    try:
+        return _picklable_result(func(*args, **kwargs))
+    except Exception as e:
+        raise RuntimeError(f"{getattr(func, '__module__', '')}.{getattr(func, '__name__', func)} failed: {e}") from None
+
+
+class QGISWorkerPool:
+    """QGIS 工作进程池（常驻进程，每个进程只初始化一次 QGIS）"""
+
+    def __init__(self, workers=None, max_tasks_per_child=None):
+        """
+        启动工作进程池。
+        :param workers: 工作进程数，默认为CPU核数
+        :param max_tasks_per_child: 每个工作进程最多执行的任务数，之后由新的进程替换（用于释放内存泄漏），默认不替换
+        """
+        options = {}
+        if max_tasks_per_child is not None:
+            options['max_tasks_per_child'] = max_tasks_per_child
+        self.workers = workers or multiprocessing.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_qgis_worker, **options)
+
+    def submit(self, algorithm, parameters):
+        """
+        提交一个Processing算法任务。
+        :param algorithm: 算法id，如 "native:buffer"
+        :param parameters: 算法参数（需可序列化，输入输出使用文件路径）
+        :return: concurrent.futures.Future，其结果为算法输出参数的字典
+        """
+        return self.executor.submit(_run_algorithm, algorithm, parameters)
+
+    def submit_function(self, func, *args, **kwargs):
+        """
+        提交一个封装函数任务，如 pyqgis_lib.GeoAnalytics.Proximity.buffer.run。
+        :param func: 模块级函数（需可按引用序列化）
+        :return: concurrent.futures.Future，其结果为函数的返回值
+        """
+        return self.executor.submit(_run_function, func, args, kwargs)
+
+    def map(self, algorithm, parameters_list):
+        """
+        并行运行一批同一算法的任务。
+        :param algorithm: 算法id
+        :param parameters_list: 每个任务的算法参数
+        :return: 各任务的输出参数字典，顺序与输入一致
+        """
+        futures = [self.submit(algorithm, parameters) for parameters in parameters_list]
+        return [future.result() for future in futures]
+
+    def run(self, algorithm, parameters):
+        """
+        运行一个任务并等待其结果。
+        """
+        return self.submit(algorithm, parameters).result()
+
+    def shutdown(self, wait=True):
+        """
+        关闭工作进程池，各进程退出时释放 QGIS 资源。
+        """
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
@@ -1 +1,3 @@
-from extension_by_driver import file_extension_by_gdal_driver
+from .extension_by_driver import file_extension_by_gdal_driver, gdal_driver_by_file_extension
+from .raster_blocks import close_worker_dataset, init_worker_dataset, iter_block_windows, worker_dataset
+from .vector_io import default_vector_engine, read_attribute_table, read_feature_batches, write_feature_batches
@@ -26,8 +26,41 @@ def file_extension_by_gdal_driver(driver_name):
         'GeoJSON'       : 'geojson',
         'ESRI Shapefile': 'shp',
         'GPKG'          : 'gpkg',    # GeoPackage
+        'FlatGeobuf'    : 'fgb',
+        'Parquet'       : 'parquet', # GeoParquet
         'KML'           : 'kml',
         'VRT'           : 'vrt'
     }
     # 获取指定 driver_name 的扩展名
     return driver_extension_map.get(driver_name, 'Unknown format')
+
+
+def gdal_driver_by_file_extension(file_name):
+    # 由文件扩展名（或文件路径）反查 GDAL driver_name
+    extension = file_name.rsplit('.', 1)[-1].lower()
+    extension_driver_map = {
+        'tif'    : 'GTiff',
+        'tiff'   : 'GTiff',
+        'img'    : 'HFA',
+        'png'    : 'PNG',
+        'jpg'    : 'JPEG',
+        'jpeg'   : 'JPEG',
+        'bmp'    : 'BMP',
+        'asc'    : 'AAIGrid',
+        'nc'     : 'netCDF',
+        'jp2'    : 'JP2OpenJPEG',
+        'hdr'    : 'ENVI',
+        'ecw'    : 'ECW',
+        'sid'    : 'MrSID',
+        'bil'    : 'EHdr',
+        'geojson': 'GeoJSON',
+        'json'   : 'GeoJSON',
+        'shp'    : 'ESRI Shapefile',
+        'gpkg'   : 'GPKG',
+        'fgb'    : 'FlatGeobuf',
+        'parquet': 'Parquet',
+        'kml'    : 'KML',
+        'vrt'    : 'VRT'
+    }
+    # 获取指定扩展名的 driver_name
+    return extension_driver_map.get(extension, 'Unknown format')
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+***
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+
+
+def iter_block_windows(width, height, block_width, block_height, min_pixels=1 << 20):
+    """
+    Iterate the windows (x_off, y_off, x_size, y_size) aligned to the native blocks of a band.
+    Strip-organised bands (block as wide as the band) are grouped into strips of at least min_pixels.
+
+    The windows are plain tuples, usable as GDAL ReadAsArray arguments or as rasterio.windows.Window(*win).
+    """
+    if block_width >= width:
+        block_width = width
+        block_height = max(block_height, block_height * (min_pixels // max(1, width * block_height)))
+    for y_off in range(0, height, block_height):
+        for x_off in range(0, width, block_width):
+            yield x_off, y_off, min(block_width, width - x_off), min(block_height, height - y_off)
+        # for
+    # for
+
+
+# 进程内的栅格句柄。每个工作进程在initializer中独立打开，避免跨进程共享GDAL句柄。
+_worker_dataset = None
+
+
+def init_worker_dataset(input_raster, library='rasterio'):
+    """
+    Open a raster for the current process, e.g. as the initializer of a ProcessPoolExecutor.
+
+    Parameters
+    ----------
+    input_raster: str
+        The raster file.
+    library: str, optional
+        'rasterio' (rasterio.open) or 'gdal' (gdal.Open). Default is 'rasterio'.
+    """
+    global _worker_dataset
+    if library == 'gdal':
+        from osgeo import gdal
+        gdal.UseExceptions()
+        _worker_dataset = gdal.Open(input_raster)
+    elif library == 'rasterio':
+        import rasterio
+        _worker_dataset = rasterio.open(input_raster)
+    else:
+        raise ValueError(f"Unknown raster library: {library}")
+
+
+def worker_dataset():
+    """
+    The raster opened by init_worker_dataset in the current process.
+    """
+    return _worker_dataset
+
+
+def close_worker_dataset():
+    """
+    Close the raster opened by init_worker_dataset in the current process.
+    """
+    global _worker_dataset
+    if hasattr(_worker_dataset, 'close'):
+        _worker_dataset.close()
+    _worker_dataset = None
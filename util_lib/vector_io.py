@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+***
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import queue
+import threading
+import fiona
+import shapely
+import geopandas as gpd
+
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+
+"""
+分块流式读写矢量图层：按batch_size条要素分块读取为GeoDataFrame，读取和写出各在一个后台线程中进行，
+与主线程的计算重叠，峰值内存只与几个分块的大小有关，而与图层大小无关。
+
+安装了pyogrio（GDAL >= 3.6）和pyarrow时，按列式的Arrow记录批读写，并将字段选择（columns）、
+范围（bbox）和属性条件（where）下推给驱动；否则退回到gpd.read_file/to_file。
+"""
+
+# 各矢量读写引擎
+VECTOR_ENGINES = ['arrow', 'pyogrio', 'fiona']
+
+# 队列结束标记
+_END = object()
+
+
+def _background_iter(iterable, prefetch=2):
+    """
+    Run an iterator in a background thread, keeping at most prefetch items ahead of the consumer.
+    The exceptions of the iterator are raised in the consumer.
+    """
+    items = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put(item)
+            # for
+            items.put(_END)
+        except BaseException as e:
+            items.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+        # while
+    finally:
+        # 消费者提前退出时，通知并释放生产者
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        # while
+
+
+def default_vector_engine(write=False):
+    """
+    The fastest available engine: 'arrow' (pyogrio with pyarrow, GDAL >= 3.6 to read and >= 3.8 to write),
+    'pyogrio', or 'fiona'.
+    """
+    if pyogrio is None:
+        return 'fiona'
+    try:
+        import pyarrow
+    except ImportError:
+        return 'pyogrio'
+    if pyogrio.__gdal_version__ < ((3, 8, 0) if write else (3, 6, 0)):
+        return 'pyogrio'
+
+    return 'arrow'
+
+
+def _layer_field_names(output_file, layer=None):
+    """
+    The attribute field names of a vector layer, in the order of the layer.
+    """
+    if pyogrio is not None:
+        return list(pyogrio.read_info(output_file, layer=layer)['fields'])
+    with fiona.open(output_file, layer=layer) as src:
+        return list(src.schema['properties'])
+
+
+def _arrow_to_geodataframe(table, geometry_name, crs, start=0):
+    """
+    Convert an Arrow table of WKB geometries to a GeoDataFrame, with a RangeIndex from start.
+    """
+    names = [name for name in table.column_names if name != geometry_name]
+    df = table.select(names).to_pandas()
+    df.index = range(start, start + len(df))
+    if geometry_name not in table.column_names:
+        return gpd.GeoDataFrame(df)
+
+    geoms = shapely.from_wkb(table.column(geometry_name).to_numpy(zero_copy_only=False))
+    return gpd.GeoDataFrame(df, geometry=gpd.GeoSeries(geoms, index=df.index, crs=crs), crs=crs)
+
+
+def _read_batches_arrow(input_file, batch_size, layer, columns, bbox, where):
+    """
+    Stream the Arrow record batches of a layer, with the filters pushed down to the driver.
+    """
+    import pyarrow as pa
+
+    with pyogrio.raw.open_arrow(input_file, layer=layer, columns=columns, bbox=bbox, where=where,
+                                batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        start = 0
+        for batch in reader:
+            yield _arrow_to_geodataframe(pa.Table.from_batches([batch]), geometry_name, meta['crs'], start)
+            start += batch.num_rows
+        # for
+
+        # 空图层（或没有满足条件的要素）也返回一个空的分块，以保留字段结构
+        if start == 0:
+            yield _arrow_to_geodataframe(reader.schema.empty_table(), geometry_name, meta['crs'])
+    # with
+
+
+def _read_batches_slices(input_file, batch_size, layer, columns, bbox, where, engine):
+    """
+    Read the batches of a layer as row slices, with pyogrio (filters pushed down) or fiona.
+    """
+    start = 0
+    while True:
+        if engine == 'pyogrio':
+            gdf = pyogrio.read_dataframe(input_file, layer=layer, columns=columns, bbox=bbox, where=where,
+                                         skip_features=start, max_features=batch_size)
+        else:
+            if where:
+                raise ValueError("The where filter requires the pyogrio engine.")
+            rows = slice(start, start + batch_size) if batch_size else None
+            gdf = gpd.read_file(input_file, layer=layer, bbox=bbox, rows=rows, engine='fiona')
+            if columns is not None:
+                gdf = gdf[list(columns) + ([gdf.geometry.name] if gdf.geometry.name not in columns else [])]
+        gdf.index = range(start, start + len(gdf))
+        if len(gdf) > 0 or start == 0:
+            yield gdf
+        if not batch_size or len(gdf) < batch_size:
+            return
+        start += batch_size
+    # while
+
+
+def read_attribute_table(input_file, columns=None, layer=None, bbox=None, where=None):
+    """
+    Read only the attribute fields of a vector layer, without the geometries, in the order of the layer.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The attribute table, with a RangeIndex.
+    """
+    if pyogrio is not None:
+        df = pyogrio.read_dataframe(input_file, layer=layer, columns=columns, bbox=bbox, where=where, read_geometry=False)
+    else:
+        if where:
+            raise ValueError("The where filter requires the pyogrio engine.")
+        df = gpd.read_file(input_file, layer=layer, bbox=bbox, ignore_geometry=True, engine='fiona')
+        if columns is not None:
+            df = df[list(columns)]
+
+    return df.reset_index(drop=True)
+
+
+def read_feature_batches(input_file, batch_size=100000, layer=None, columns=None, bbox=None, where=None, engine=None, prefetch=2):
+    """
+    Read a vector layer as GeoDataFrame batches, in a background thread.
+
+    Parameters
+    ----------
+    input_file : str
+        The input vector file.
+    batch_size : int, optional
+        The number of features of each batch. Default is 100000. None reads the whole layer as one batch.
+    layer : str, optional
+        The layer name, for multi-layer formats. Default is None, i.e. the first layer.
+    columns : list of str, optional
+        The attribute fields to read. Default is None, i.e. all fields.
+    bbox : tuple, optional
+        Read only the features intersecting the bounding box (xmin, ymin, xmax, ymax), in the CRS of the layer.
+    where : str, optional
+        Read only the features satisfying the SQL WHERE clause, e.g. "class = 3". Requires pyogrio.
+        The fields of the clause must be among the columns read, the other fields being ignored by the driver.
+    engine : str, optional
+        'arrow', 'pyogrio' or 'fiona'. Default is None, i.e. the fastest available.
+    prefetch : int, optional
+        The number of batches read ahead of the consumer. Default is 2.
+
+    Yields
+    ------
+    geopandas.GeoDataFrame
+        The batches in the order of the layer, with a RangeIndex continuing from the previous batch.
+        An empty layer yields one empty batch, so the schema can still be written.
+    """
+    if engine is None:
+        engine = default_vector_engine()
+    if engine not in VECTOR_ENGINES:
+        raise ValueError(f"Unknown vector engine: {engine}")
+
+    if engine == 'arrow' and batch_size:
+        batches = _read_batches_arrow(input_file, batch_size, layer, columns, bbox, where)
+    elif engine == 'arrow':
+        batches = iter([pyogrio.read_dataframe(input_file, layer=layer, columns=columns, bbox=bbox, where=where, use_arrow=True)])
+    else:
+        batches = _read_batches_slices(input_file, batch_size, layer, columns, bbox, where, engine)
+
+    return _background_iter(batches, prefetch)
+
+
+def write_feature_batches(batches, output_file, driver=None, layer=None, engine=None, prefetch=2):
+    """
+    Write GeoDataFrame batches to a vector layer, in a background thread.
+
+    The first batch creates the layer and the next ones are appended, so the batches must share the schema.
+    The field names changed by the driver when creating the layer (e.g. cut to 10 characters in a shapefile)
+    are applied to the next batches too.
+    The batches are consumed in the calling thread: a generator computing them runs concurrently with the writer.
+
+    Parameters
+    ----------
+    batches : iterable of geopandas.GeoDataFrame
+        The batches to write.
+    output_file : str
+        The output vector file.
+    driver : str, optional
+        The OGR driver. Default is None, i.e. inferred from the output extension.
+    layer : str, optional
+        The layer name, for multi-layer formats. Default is None.
+    engine : str, optional
+        'arrow', 'pyogrio' or 'fiona'. Default is None, i.e. the fastest available.
+    prefetch : int, optional
+        The number of batches waiting for the writer. Default is 2.
+
+    Returns
+    -------
+    int
+        The number of features written.
+    """
+    if engine is None:
+        engine = default_vector_engine(write=True)
+    if engine not in VECTOR_ENGINES:
+        raise ValueError(f"Unknown vector engine: {engine}")
+
+    pending = queue.Queue(maxsize=max(1, prefetch))
+    errors = []
+
+    def consume():
+        first = True
+        renamed = None
+        while True:
+            gdf = pending.get()
+            if gdf is _END:
+                return
+            if errors:
+                continue
+            try:
+                if renamed:
+                    gdf = gdf.rename(columns=renamed)
+                if engine == 'fiona':
+                    gdf.to_file(output_file, driver=driver, layer=layer, mode='w' if first else 'a', engine='fiona')
+                else:
+                    pyogrio.write_dataframe(gdf, output_file, layer=layer, driver=driver, append=not first, use_arrow=engine == 'arrow')
+                if first:
+                    # 驱动创建图层时可能修改字段名（如Shapefile截断为10个字符），后续分块按图层中实际的字段名追加
+                    columns = [column for column in gdf.columns if column != gdf.geometry.name]
+                    fields = _layer_field_names(output_file, layer)
+                    if len(fields) == len(columns):
+                        renamed = {column: field for column, field in zip(columns, fields) if column != field}
+            except BaseException as e:
+                errors.append(e)
+            first = False
+        # while
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    n_written = 0
+    try:
+        for gdf in batches:
+            if errors:
+                break
+            pending.put(gdf)
+            n_written += len(gdf)
+        # for
+    finally:
+        pending.put(_END)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    return n_written